@@ -0,0 +1,51 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from config import API_CONCURRENCY
+from helpers import log
+
+
+class AsyncApiClient:
+    # medsenger_api is blocking, so calls run on one pool shared by the process and the semaphore
+    # keeps a single fan-out from taking all of it
+    executor = ThreadPoolExecutor(max_workers=API_CONCURRENCY)
+
+    def __init__(self, medsenger_api, limit=API_CONCURRENCY):
+        self.medsenger_api = medsenger_api
+        self.limit = limit
+
+    def __getattr__(self, name):
+        method = getattr(self.medsenger_api, name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+
+        return call
+
+    async def call(self, semaphore, method, args=(), kwargs=None):
+        if isinstance(method, str):
+            method = getattr(self.medsenger_api, method)
+
+        async with semaphore:
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, partial(method, *args, **(kwargs or {})))
+            except Exception as e:
+                log(e)
+                return None
+
+    async def gather_async(self, calls, limit=None):
+        semaphore = asyncio.Semaphore(limit or self.limit)
+        return await asyncio.gather(*[self.call(semaphore, *call) for call in calls])
+
+    def gather(self, calls, limit=None):
+        # calls are (method, args) or (method, args, kwargs), method is an api method name or a callable;
+        # results come back in the same order, a failed call gives None
+        calls = list(calls)
+
+        if not calls:
+            return []
+
+        return asyncio.run(self.gather_async(calls, limit))
@@ -0,0 +1,110 @@
+# Measures the action_request lookups used by log_done and compliance counting as the table grows.
+#
+#   python -m benchmarks.action_requests --rows 100000 1000000 10000000
+#   python -m benchmarks.action_requests --db postgresql://postgres@localhost/forms-benchmark --no-index
+#
+# Run from the repository root with a config.py in place. Rows are generated inside the database, so tens of
+# millions are practical on postgres. --no-index drops the composite indexes to compare against the old plan.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import func, insert, text
+
+from benchmarks.common import create_app
+from models import db, ActionRequest, Contract, Patient
+
+GENERATE = {
+    'postgresql': """
+        INSERT INTO action_request (contract_id, action, is_done, sent)
+        SELECT 1 + i % :contracts, 'medicine_' || (i % :actions), i % 3 = 0, now() - (i % 365) * interval '1 day'
+        FROM generate_series(:start, :end) AS i
+    """,
+    'sqlite': """
+        WITH RECURSIVE series(i) AS (SELECT :start UNION ALL SELECT i + 1 FROM series WHERE i < :end)
+        INSERT INTO action_request (contract_id, action, is_done, sent)
+        SELECT 1 + i % :contracts, 'medicine_' || (i % :actions), i % 3 = 0, datetime('now', '-' || (i % 365) || ' days')
+        FROM series
+    """,
+}
+
+
+def last_request(contract_id, action):
+    return ActionRequest.query.filter_by(contract_id=contract_id, action=action).order_by(
+        ActionRequest.id.desc()).first()
+
+
+def count_requests(contract_id, action, start_date):
+    return db.session.query(func.count(ActionRequest.id),
+                            func.count(ActionRequest.id).filter(ActionRequest.is_done == True)).filter(
+        (ActionRequest.contract_id == contract_id) & (ActionRequest.action == action) &
+        (ActionRequest.sent >= start_date)).one()
+
+
+def timed(query, samples):
+    start = time.perf_counter()
+
+    for args in samples:
+        query(*args)
+
+    return (time.perf_counter() - start) * 1000 / len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='sqlite:///' + os.path.join(tempfile.gettempdir(), 'forms-benchmark.db'))
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--contracts', type=int, default=10000)
+    parser.add_argument('--actions', type=int, default=20, help='actions per contract')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--no-index', action='store_true')
+    args = parser.parse_args()
+
+    app = create_app(args.db)
+    rng = random.Random(0)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        if args.no_index:
+            for index in ActionRequest.__table__.indexes:
+                index.drop(db.engine)
+
+        db.session.execute(insert(Patient), [{"id": i} for i in range(1, args.contracts + 1)])
+        db.session.execute(insert(Contract), [{"id": i, "patient_id": i} for i in range(1, args.contracts + 1)])
+        db.session.commit()
+
+        generate = text(GENERATE[db.engine.dialect.name])
+        month_start = datetime.now().replace(day=1, minute=0, hour=0, second=0)
+        total = 0
+
+        print("{:>12} {:>16} {:>16}".format('rows', 'log_done ms', 'compliance ms'))
+
+        for rows in sorted(args.rows):
+            if rows > total:
+                db.session.execute(generate, {"contracts": args.contracts, "actions": args.actions,
+                                              "start": total + 1, "end": rows})
+                db.session.commit()
+                total = rows
+
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute(text("ANALYZE action_request"))
+
+            samples = [(rng.randint(1, args.contracts), 'medicine_{}'.format(rng.randrange(args.actions)))
+                       for i in range(args.samples)]
+
+            print("{:>12} {:>16.3f} {:>16.3f}".format(
+                total, timed(last_request, samples),
+                timed(lambda contract_id, action: count_requests(contract_id, action, month_start), samples)))
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
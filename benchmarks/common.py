@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import event, insert
+
+from helpers import timezone_now
+from models import db, Patient, Contract, Medicine, Form, Reminder, Algorithm, Outbox
+
+ZONES = ['Europe/Moscow', 'Europe/Kaliningrad', 'Asia/Yekaterinburg', 'Asia/Novosibirsk', 'Asia/Vladivostok']
+CHUNK = 5000
+
+
+class StubAgentApiClient:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+            if self.latency:
+                time.sleep(self.latency)
+
+            if name == 'get_patient_info':
+                return {"id": 1, "timezone": "Europe/Moscow", "timezone_offset": None, "public_attachments": []}
+
+            return {"id": 1, "task_id": 1}
+
+        return call
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+def create_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    db.init_app(app)
+
+    return app
+
+
+def timetable(local, due, rng):
+    if due:
+        point = local - timedelta(minutes=1)
+        return {"mode": "daily", "points": [{"hour": point.hour, "minute": point.minute}]}
+
+    mode = rng.choice(['daily', 'daily', 'weekly', 'monthly'])
+    points = []
+
+    for i in range(rng.randint(1, 3)):
+        point = {"hour": rng.randint(6, 22), "minute": rng.choice([0, 15, 30, 45])}
+
+        if mode == 'weekly':
+            point['day'] = rng.randint(0, 6)
+        if mode == 'monthly':
+            point['day'] = rng.randint(1, 28)
+
+        points.append(point)
+
+    return {"mode": mode, "points": points}
+
+
+def populate(contracts, due=0.01, forgotten=0.02, timeouts=0.05, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    utcnow = datetime.utcnow()
+    local_now = {zone: timezone_now(zone) for zone in ZONES}
+    rows = {Patient: [], Contract: [], Medicine: [], Form: [], Reminder: [], Algorithm: []}
+
+    def flush(force=False):
+        for model, items in rows.items():
+            if items and (force or len(items) >= CHUNK):
+                db.session.execute(insert(model), items)
+                items.clear()
+
+    def scheduled(contract_id, zone):
+        is_due = rng.random() < due
+        is_forgotten = rng.random() < forgotten
+
+        return {
+            "contract_id": contract_id,
+            "patient_id": contract_id,
+            "timetable": timetable(local_now[zone], is_due, rng),
+            "last_sent": now - timedelta(days=1),
+            "next_fire_at": utcnow - timedelta(minutes=1) if is_due else utcnow + timedelta(
+                minutes=rng.randint(10, 60 * 24)),
+            "warning_days": 3 if is_forgotten else 0,
+            "warning_timestamp": 0,
+            "asked_timestamp": int(time.time()) - 5 * 24 * 60 * 60 if is_forgotten else 0,
+        }
+
+    for contract_id in range(1, contracts + 1):
+        zone = rng.choice(ZONES)
+
+        rows[Patient].append({"id": contract_id})
+        rows[Contract].append({"id": contract_id, "patient_id": contract_id, "is_active": True,
+                               "clinic_timezone": zone, "clinic_id": rng.randint(1, 20)})
+
+        for i in range(2):
+            medicine = scheduled(contract_id, zone)
+            medicine.update({"title": "Medicine {}".format(i), "dose": "1 tablet",
+                             "prescribed_at": now - timedelta(days=30)})
+            rows[Medicine].append(medicine)
+
+        form = scheduled(contract_id, zone)
+        form.update({"title": "Form", "fields": [], "categories": "systolic_pressure|diastolic_pressure"})
+        rows[Form].append(form)
+
+        if rng.random() < 0.25:
+            reminder = scheduled(contract_id, zone)
+            del reminder['warning_days'], reminder['warning_timestamp'], reminder['asked_timestamp']
+            reminder.update({"type": "patient", "text": "Reminder", "send_next": None})
+            rows[Reminder].append(reminder)
+
+        rows[Algorithm].append({
+            "contract_id": contract_id,
+            "patient_id": contract_id,
+            "title": "Algorithm",
+            "categories": "exact_time" if rng.random() < 0.1 else "systolic_pressure",
+            "steps": [{"uid": "step", "conditions": [], "timeout_actions": [
+                {"type": "order", "params": {"order": "benchmark", "agent_id": 1, "order_params": {}}}]}],
+            "initial_step": "step",
+            "current_step": "step",
+            "timeout_at": int(time.time()) - 60 if rng.random() < timeouts else 0,
+        })
+
+        flush()
+
+    flush(True)
+    db.session.commit()
+
+
+def count_outbox(app):
+    with app.app_context():
+        return db.session.query(Outbox).count()
+
+
+@contextmanager
+def measure(app, api, counter):
+    # notifications only reach the api through the outbox sender, so queued rows are counted as outbound calls
+    queued = count_outbox(app)
+    api.reset()
+    counter.count = 0
+    result = {}
+    start = time.perf_counter()
+
+    yield result
+
+    result['seconds'] = time.perf_counter() - start
+    result['queries'] = counter.count
+    result['calls'] = api.total()
+    result['queued'] = count_outbox(app) - queued
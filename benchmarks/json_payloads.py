@@ -0,0 +1,100 @@
+# Compares Flask's default JSON provider with OrjsonProvider on patient and template catalog payloads.
+#
+#   python -m benchmarks.json_payloads
+#   python -m benchmarks.json_payloads --payload captured_get_patient.json --payload captured_templates.json
+#
+# Run from the repository root with a config.py in place. Captured payloads are response bodies saved from the
+# real endpoints; without them synthetic ones are built from the models.
+
+import argparse
+import json
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from benchmarks.common import create_app, populate
+from json_provider import OrjsonProvider
+from models import db, Patient, Form, Algorithm, Medicine
+
+
+def synthetic_payloads(templates):
+    fields = [{"uid": "field_{}".format(i), "type": "radio", "text": "Вопрос {}".format(i), "category": "symptom",
+               "params": {"variants": [{"text": "Вариант {}".format(j), "category": "symptom", "weight": j}
+                                       for j in range(5)]}} for i in range(20)]
+    steps = [{"uid": "step_{}".format(i), "conditions": [{"criteria": [[{"left_mode": "value", "sign": "greater",
+                                                                         "value": 140, "category": "systolic_pressure"}]],
+                                                          "positive_actions": [], "negative_actions": []}],
+              "timeout_actions": []} for i in range(5)]
+
+    for i in range(templates):
+        db.session.add(Form(is_template=True, title="Опросник {}".format(i), fields=fields, timetable={
+            "mode": "daily", "points": [{"hour": 9, "minute": 0}]}, categories="symptom"))
+        db.session.add(Algorithm(is_template=True, title="Алгоритм {}".format(i), steps=steps,
+                                 categories="systolic_pressure"))
+        db.session.add(Medicine(is_template=True, title="Препарат {}".format(i), dose="1 таблетка",
+                                timetable={"mode": "daily", "points": [{"hour": 9, "minute": 0}]}))
+
+    for i in range(10):
+        db.session.add(Form(contract_id=1, patient_id=1, title="Опросник {}".format(i), fields=fields,
+                            timetable={"mode": "daily", "points": [{"hour": 9, "minute": 0}]}))
+    db.session.commit()
+
+    return {
+        "get_patient": Patient.query.get(1).as_dict(),
+        "templates": {
+            "forms": [form.as_dict() for form in Form.query.filter_by(is_template=True)],
+            "algorithms": [algorithm.as_dict() for algorithm in Algorithm.query.filter_by(is_template=True)],
+            "medicines": [medicine.as_dict() for medicine in Medicine.query.filter_by(is_template=True)],
+        }
+    }
+
+
+def timed(function, payload, repeat):
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        function(payload)
+
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payload', action='append', default=[])
+    parser.add_argument('--templates', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app('sqlite://')
+
+    with app.app_context():
+        db.create_all()
+        populate(1, due=0)
+
+        if args.payload:
+            payloads = {}
+            for path in args.payload:
+                with open(path) as f:
+                    payloads[path] = json.load(f)
+        else:
+            payloads = synthetic_payloads(args.templates)
+
+        default = DefaultJSONProvider(app)
+        fast = OrjsonProvider(app)
+
+        print("{:<32} {:>10} {:>12} {:>12} {:>8} {:>6}".format('payload', 'kb', 'default ms', 'orjson ms',
+                                                               'speedup', 'same'))
+
+        for name, payload in payloads.items():
+            expected = default.response(payload).get_data()
+            actual = fast.response(payload).get_data()
+            default_ms = timed(default.response, payload, args.repeat)
+            fast_ms = timed(fast.response, payload, args.repeat)
+
+            print("{:<32} {:>10.1f} {:>12.3f} {:>12.3f} {:>8.1f} {:>6}".format(
+                name[-32:], len(expected) / 1024, default_ms, fast_ms, default_ms / fast_ms,
+                str(json.loads(expected) == json.loads(actual))))
+
+
+if __name__ == '__main__':
+    main()
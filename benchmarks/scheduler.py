@@ -0,0 +1,76 @@
+# Measures scheduler ticks against a synthetic population.
+#
+#   python -m benchmarks.scheduler --contracts 1000 10000 100000
+#   python -m benchmarks.scheduler --db postgresql://postgres@localhost/forms-benchmark
+#
+# Run from the repository root with a config.py in place. The database is dropped and recreated for every size.
+#
+# "api calls" are the direct calls made during the tick, "queued" are the notifications written to the outbox
+# for forms_outbox.py to send; together they are the outbound calls the tick causes.
+
+import argparse
+import os
+import tempfile
+
+from benchmarks.common import StubAgentApiClient, QueryCounter, create_app, populate, measure
+from managers.AlgorithmManager import AlgorithmManager
+from managers.FormManager import FormManager
+from managers.MedicineManager import MedicineManager
+from managers.ReminderManager import ReminderManager
+from managers.TimetableManager import TimetableManager
+from models import db
+
+JOBS = ['iterate', 'check_forgotten', 'check_timeouts']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='sqlite:///' + os.path.join(tempfile.gettempdir(), 'forms-benchmark.db'))
+    parser.add_argument('--contracts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--jobs', nargs='+', default=JOBS, choices=JOBS)
+    parser.add_argument('--due', type=float, default=0.01, help='share of medicines, forms and reminders due now')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per api call')
+    args = parser.parse_args()
+
+    app = create_app(args.db)
+    api = StubAgentApiClient(args.latency)
+
+    medicine_manager = MedicineManager(api, db)
+    form_manager = FormManager(api, db)
+    reminder_manager = ReminderManager(api, db)
+    timetable_manager = TimetableManager(medicine_manager, form_manager, reminder_manager, api, db)
+    algorithm_manager = AlgorithmManager(api, db)
+
+    jobs = {
+        'iterate': timetable_manager.iterate,
+        'check_forgotten': timetable_manager.check_forgotten,
+        'check_timeouts': algorithm_manager.check_timeouts,
+    }
+
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+
+    print("{:>10} {:<16} {:>10} {:>10} {:>10} {:>10}".format('contracts', 'job', 'seconds', 'queries', 'api calls',
+                                                             'queued'))
+
+    for contracts in args.contracts:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            populate(contracts, due=args.due)
+
+        for job in args.jobs:
+            with measure(app, api, counter) as result:
+                jobs[job](app)
+
+            print("{:>10} {:<16} {:>10.3f} {:>10} {:>10} {:>10}".format(contracts, job, result['seconds'],
+                                                                        result['queries'], result['calls'],
+                                                                        result['queued']))
+
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,15 @@ def status(data):
     return jsonify(answer)
 
 
+@app.route('/metrics', methods=['GET'])
+@verify_request(contract_manager, 'backend')
+def metrics(args, form, contract):
+    return jsonify({
+        "patient_info": get_patient_info_stats(),
+        "outbox": outbox_manager.get_stats()
+    })
+
+
 @app.route('/order', methods=['POST'])
 @verify_request(contract_manager, 'backend')
 def order(data):
@@ -47,10 +56,12 @@ def order(data):
             'medicines': medicines,
             'canceled_medicines': canceled_medicines
         }
-        medsenger_api.send_order(contract.id, 'conclusion_params', None, params)
+        outbox.send_order(contract.id, 'conclusion_params', None, params)
+        db.session.commit()
         return 'ok'
 
     if data['order'] == 'new_timezone':
+        invalidate_patient_info(contract.id)
         contract_manager.actualize_timezone(contract, commit=True)
 
     return "not found"
@@ -66,6 +77,7 @@ def init(data):
     if not contract_id:
         abort(422)
 
+    invalidate_patient_info(contract_id)
     contract, is_new = contract_manager.add(contract_id, clinic_id)
 
     params = data.get('params')
@@ -193,6 +205,7 @@ def remove(data):
     if not contract_id:
         abort(422)
 
+    invalidate_patient_info(contract_id)
     contract_manager.remove(contract_id)
 
     return "ok"
@@ -243,19 +256,19 @@ def message(data):
 @app.route('/settings', methods=['GET'])
 @verify_request(contract_manager, 'backend')
 def get_settings(args, form, contract):
-    return get_ui('settings', contract, medsenger_api.get_categories(), role='doctor')
+    return get_ui('settings', contract, category_manager.get_json(), role='doctor')
 
 
 @app.route('/preview_form/<form_id>', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def form_preview_page(args, form, contract, form_id):
-    return get_ui('form', contract, medsenger_api.get_categories(), form_id, True, role='doctor')
+    return get_ui('form', contract, category_manager.get_json(), form_id, True, role='doctor')
 
 
 @app.route('/form/<form_id>', methods=['GET'])
 @verify_request(contract_manager, 'patient')
 def form_page(args, form, contract, form_id):
-    return get_ui('form', contract, medsenger_api.get_categories(), form_id, role='patient')
+    return get_ui('form', contract, category_manager.get_json(), form_id, role='patient')
 
 
 @app.route('/outsource_form/<form_id>', methods=['GET'])
@@ -283,26 +296,26 @@ def medicine_page(args, form, contract, medicine_id):
 @app.route('/medicine-manager', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def medicine_editor_page(args, form, contract):
-    return get_ui('settings', contract, medsenger_api.get_categories(), dashboard_parts=['meds'], role='doctor')
+    return get_ui('settings', contract, category_manager.get_json(), dashboard_parts=['meds'], role='doctor')
 
 
 @app.route('/form-manager', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def forms_editor_page(args, form, contract):
-    return get_ui('settings', contract, medsenger_api.get_categories(), dashboard_parts=['forms', 'algorithms'],
+    return get_ui('settings', contract, category_manager.get_json(), dashboard_parts=['forms', 'algorithms'],
                   role='doctor')
 
 
 @app.route('/reminder-manager', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def notification_editor_page(args, form, contract):
-    return get_ui('settings', contract, medsenger_api.get_categories(), dashboard_parts=['reminders'], role='doctor')
+    return get_ui('settings', contract, category_manager.get_json(), dashboard_parts=['reminders'], role='doctor')
 
 
 @app.route('/medicines-list', methods=['GET'])
 @verify_request(contract_manager, 'patient')
 def medicines_list_page(args, form, contract):
-    return get_ui('medicines-list', contract, medsenger_api.get_categories(), role='patient')
+    return get_ui('medicines-list', contract, category_manager.get_json(), role='patient')
 
 
 # settings api
@@ -310,7 +323,7 @@ def medicines_list_page(args, form, contract):
 @verify_request(contract_manager, 'doctor')
 def get_data(args, form, contract):
     patient = contract.patient.as_dict()
-    patient["info"] = medsenger_api.get_patient_info(contract.id)
+    patient["info"] = get_patient_info(medsenger_api, contract.id)
     patient["current_contract"] = contract.as_dict()
 
     return jsonify(patient)
@@ -332,15 +345,31 @@ def get_open_data(args, form, contract):
 @app.route('/api/settings/get_templates', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def get_templates(args, form, contract):
-    templates = {
-        "forms": form_manager.get_templates_as_dicts(),
-        "medicines": medicine_manager.get_templates_as_dicts(),
-        "reminders": reminder_manager.get_templates_as_dicts(),
-        "algorithms": algorithm_manager.get_templates_as_dicts(),
-        "examinations": examination_manager.get_templates_as_dicts()
-    }
+    return catalog_manager.response(request)
+
+
+@app.route('/api/settings/templates/<kind>', methods=['GET'])
+@verify_request(contract_manager, 'doctor')
+def get_template_summaries(args, form, contract, kind):
+    if kind not in MODELS:
+        abort(404)
+
+    if args.get('category') and not catalog_manager.supports_category(kind):
+        abort(422)
 
-    return jsonify(templates)
+    return jsonify(catalog_manager.get_summaries(kind, contract,
+                                                 category=args.get('category'), search=args.get('search'),
+                                                 cursor=args.get('cursor', type=int),
+                                                 limit=args.get('limit', 50, type=int)))
+
+
+@app.route('/api/settings/templates/<kind>/<int:template_id>', methods=['GET'])
+@verify_request(contract_manager, 'doctor')
+def get_template(args, form, contract, kind, template_id):
+    if kind not in MODELS:
+        abort(404)
+
+    return jsonify(catalog_manager.get_template(kind, template_id).as_dict())
 
 
 @app.route('/api/settings/form', methods=['POST'])
@@ -349,7 +378,7 @@ def create_form(args, form, contract):
     form = form_manager.create_or_edit(request.json, contract)
 
     if form:
-        return jsonify(form.as_dict())
+        return jsonify(form.as_dict(include=get_include(args)))
     else:
         abort(422)
 
@@ -373,7 +402,7 @@ def create_medicine(args, form, contract):
     form = medicine_manager.create_or_edit(request.json, contract)
 
     if form:
-        return jsonify(form.as_dict())
+        return jsonify(form.as_dict(include=get_include(args)))
     else:
         abort(422)
 
@@ -384,7 +413,7 @@ def edit_medicine_history(args, form, contract):
     form = medicine_manager.edit_history(request.json)
 
     if form:
-        return jsonify(form.as_dict())
+        return jsonify(form.as_dict(include=get_include(args)))
     else:
         abort(422)
 
@@ -446,7 +475,7 @@ def create_reminder(args, form, contract):
 @app.route('/reminder/<reminder_id>', methods=['GET'])
 @verify_request(contract_manager, 'patient')
 def reminder_page(args, form, contract, reminder_id):
-    return get_ui('confirm-reminder', contract, medsenger_api.get_categories(), reminder_id, role='patient')
+    return get_ui('confirm-reminder', contract, category_manager.get_json(), reminder_id, role='patient')
 
 
 @app.route('/api/reminder/<reminder_id>', methods=['GET'])
@@ -525,7 +554,7 @@ def get_form(args, form, contract, form_id):
 
     if form.contract_id != int(args.get('contract_id')) and not form.is_template:
         abort(401)
-    answer = form.as_dict()
+    answer = form.as_dict(include=get_include(args))
     if args.get('source') == 'patient' or args.get('agent_token') == contract.patient_agent_token:
         answer['preview'] = False
     else:
@@ -580,6 +609,7 @@ def send_form(args, form, contract, form_id):
     contract_id = int(args.get('contract_id'))
 
     form_manager.run(form, contract_id=contract_id, commit=False)
+    db.session.commit()
 
     return jsonify({
         "result": "ok",
@@ -594,7 +624,7 @@ def get_medicine(args, form, contract, medicine_id):
     if medicine.contract_id != int(args.get('contract_id')) and not medicine.is_template:
         abort(401)
 
-    return jsonify(medicine.as_dict())
+    return jsonify(medicine.as_dict(include=get_include(args)))
 
 
 @app.route('/api/medicine/<medicine_id>/disable_notifications', methods=['POST'])
@@ -605,9 +635,10 @@ def disable_notifications(args, form, contract, medicine_id):
     if medicine.contract_id != int(args.get('contract_id')):
         abort(401)
     medicine.notifications_disabled = True
+    medicine.next_fire_at = None
     db.session.commit()
 
-    return jsonify(medicine.as_dict())
+    return jsonify(medicine.as_dict(include=get_include(args)))
 
 
 @app.route('/api/medicine/<medicine_id>/enable_notifications', methods=['POST'])
@@ -618,9 +649,10 @@ def enable_notifications(args, form, contract, medicine_id):
     if medicine.contract_id != int(args.get('contract_id')):
         abort(401)
     medicine.notifications_disabled = False
+    medicine.next_fire_at = medicine_manager.calculate_next_fire(medicine)
     db.session.commit()
 
-    return jsonify(medicine.as_dict())
+    return jsonify(medicine.as_dict(include=get_include(args)))
 
 
 @app.route('/api/confirm-medicine', methods=['POST'])
@@ -652,19 +684,19 @@ def get_medicine_template(args, form, contract):
 @verify_request(contract_manager, 'patient')
 def examinations_list_page(args, form, contract):
     contract = contract_manager.get(args.get('contract_id'))
-    return get_ui('examinations-list', contract, medsenger_api.get_categories())
+    return get_ui('examinations-list', contract, category_manager.get_json())
 
 
 @app.route('/examination-manager', methods=['GET'])
 @verify_request(contract_manager, 'doctor')
 def examination_editor_page(args, form, contract):
-    return get_ui('settings', contract, medsenger_api.get_categories(), dashboard_parts=['examinations'], role='doctor')
+    return get_ui('settings', contract, category_manager.get_json(), dashboard_parts=['examinations'], role='doctor')
 
 
 @app.route('/examination/<examination_id>', methods=['GET'])
 @verify_request(contract_manager, 'patient')
 def examination_page(args, form, contract, examination_id):
-    return get_ui('examination', contract, medsenger_api.get_categories(), examination_id, role='patient')
+    return get_ui('examination', contract, category_manager.get_json(), examination_id, role='patient')
 
 
 @app.route('/api/settings/examination', methods=['POST'])
@@ -732,9 +764,10 @@ def get_examination_files(args, form, contract, examination_id):
     record = medsenger_api.get_record_by_id(contract_id, examination.record_id)
 
     files = []
-    for file_info in record['attached_files']:
-        file = medsenger_api.get_file(contract_id, file_info['id'])
-        print(file_info)
+    file_infos = record['attached_files']
+    contents = examination_manager.gather(('get_file', (contract_id, file_info['id'])) for file_info in file_infos)
+
+    for file_info, file in zip(file_infos, contents):
         files.append({
             'base64': file['base64'],
             'type': file_info.get('type', 'text/plain'),
@@ -1,13 +1,22 @@
 from forms_bot import *
+from managers.ShardManager import ShardManager
 from apscheduler.schedulers.background import BlockingScheduler
 
+shard_manager = ShardManager(SCHEDULER_SHARDS, medsenger_api, db)
+sharded = shard_manager.sharded
+leading = shard_manager.leading
+
+leading(timetable_manager.update_schedule)(app)
+
 scheduler = BlockingScheduler()
-scheduler.add_job(timetable_manager.iterate, 'interval', minutes=1, args=(app, ))
-scheduler.add_job(algorithm_manager.check_timeouts, 'interval', minutes=1, args=(app, ))
-scheduler.add_job(timetable_manager.check_forgotten, 'interval', days=1, args=(app, ))
-scheduler.add_job(timetable_manager.check_hours, 'interval', hours=1, args=(app, ))
-scheduler.add_job(timetable_manager.check_days, 'cron', hour=7, minute=1, second=0, args=(app, ))
-scheduler.add_job(timetable_manager.update_daily_tasks, 'cron', hour=3, minute=1, second=0, args=(app, ))
-scheduler.add_job(algorithm_manager.check_detach_dates, 'cron', hour=3, minute=1, second=0, args=(app, ))
-scheduler.add_job(medicine_manager.check_detach_dates, 'cron', hour=3, minute=1, second=0, args=(app, ))
+scheduler.add_job(sharded(timetable_manager.iterate), 'interval', minutes=1, args=(app, ))
+scheduler.add_job(sharded(algorithm_manager.check_timeouts), 'interval', minutes=1, args=(app, ))
+scheduler.add_job(leading(timetable_manager.check_forgotten), 'interval', days=1, args=(app, ))
+scheduler.add_job(leading(timetable_manager.check_hours), 'interval', hours=1, args=(app, ))
+# daily jobs run every hour for the contracts whose local time has reached the job's hour
+scheduler.add_job(leading(timetable_manager.check_days), 'cron', minute=1, second=0, args=(app, ))
+scheduler.add_job(leading(timetable_manager.update_daily_tasks), 'cron', minute=1, second=0, args=(app, ))
+scheduler.add_job(leading(algorithm_manager.check_detach_dates), 'cron', minute=1, second=0, args=(app, ))
+scheduler.add_job(leading(medicine_manager.check_detach_dates), 'cron', minute=1, second=0, args=(app, ))
+scheduler.add_job(leading(archive_manager.archive), 'cron', hour=4, minute=31, second=0, args=(app, ))
 scheduler.start()
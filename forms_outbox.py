@@ -0,0 +1,3 @@
+from manage import app, outbox_manager
+
+outbox_manager.run(app)
@@ -1,13 +1,18 @@
 import json
 import threading
+from bisect import bisect_right
+from functools import lru_cache
 from datetime import datetime, timedelta
 from flask import request, abort, jsonify, render_template
 from config import *
 from sentry_sdk import capture_exception
 from pytz import timezone, utc
 import sys, os
+import redis
 
 DATACACHE = {}
+PATIENT_INFO_TTL = 600
+TEMPLATES_VERSION = {'local': 0}
 
 
 def gts():
@@ -41,12 +46,17 @@ def get_ui(page, contract, categories='[]', object_id=None, is_preview=False, da
                            contract_id=contract.id if contract else 'undefined',
                            api_host=MAIN_HOST, localhost=LOCALHOST, jshost=JSHOST,
                            agent_token=token,
-                           agent_id=AGENT_ID, categories=json.dumps(categories),
+                           agent_id=AGENT_ID,
+                           categories=categories if isinstance(categories, str) else json.dumps(categories),
                            is_admin=str(bool(contract.is_admin)).lower() if contract else 'false',
                            lc=dir_last_updated('static'), clinic_id=contract.clinic_id if contract else 'undefined',
                            is_preview=str(is_preview).lower(), dashboard_parts=json.dumps(dashboard_parts))
 
 
+def get_include(args):
+    return [field.strip() for field in args.get('include', '').split(',') if field.strip()]
+
+
 def delayed(delay, f, args):
     timer = threading.Timer(delay, f, args=args)
     timer.start()
@@ -188,31 +198,150 @@ def generate_timetable(start, end, times):
     return timetable
 
 
-def timezone_now(zone=None):
+@lru_cache(maxsize=None)
+def get_timezone(zone='Europe/Moscow'):
+    return timezone(zone)
+
+
+def get_tz(zone=None):
     if isinstance(zone, str) and zone:
-        tz = timezone(zone)
+        return get_timezone(zone)
     elif zone:
-        tz = zone
-    else:
-        tz = timezone('Europe/Moscow')
+        return zone
 
-    return datetime.now(tz)
+    return get_timezone()
+
+
+def timezone_now(zone=None):
+    return datetime.now(get_tz(zone))
 
 
 def localize(d, zone=None):
-    if isinstance(zone, str) and zone:
-        tz = timezone(zone)
-    elif zone:
-        tz = zone
-    else:
-        tz = timezone('Europe/Moscow')
+    if d.tzinfo is not None:
+        return d.astimezone(get_tz(zone))
+
+    return get_tz(zone).localize(d)
 
-    return tz.localize(d)
 
 def toUTC(d):
     return d.astimezone(utc)
 
 
+def compile_timetable(timetable):
+    mode = timetable.get('mode')
+    days = {}
+
+    for point in timetable.get('points', []):
+        day = int(point['day']) if mode in ['weekly', 'monthly'] else None
+        days.setdefault(day, []).append(int(point['hour']) * 60 + int(point['minute']))
+
+    return mode, {day: sorted(minutes) for day, minutes in days.items()}
+
+
+def get_day_minutes(compiled, day):
+    mode, days = compiled
+
+    if mode == 'manual':
+        return []
+    if mode == 'weekly':
+        return days.get(day.weekday(), [])
+    if mode == 'monthly':
+        return days.get(day.day, [])
+
+    return days.get(None, [])
+
+
+def next_timepoint(compiled, since, zone=None, horizon=63):
+    # since must be in the same zone as the timetable
+    start = since.hour * 60 + since.minute
+
+    for offset in range(horizon):
+        day = since.date() + timedelta(days=offset)
+        minutes = get_day_minutes(compiled, day)
+
+        if offset == 0:
+            minutes = minutes[bisect_right(minutes, start):]
+
+        if minutes:
+            return localize(datetime(year=day.year, month=day.month, day=day.day,
+                                     hour=minutes[0] // 60, minute=minutes[0] % 60), zone)
+
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    return redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+
+
+def get_templates_version():
+    try:
+        return int(get_redis().get('forms:templates_version') or 0)
+    except Exception as e:
+        log(e)
+        return None
+
+
+def bump_templates_version():
+    TEMPLATES_VERSION['local'] += 1
+
+    try:
+        get_redis().incr('forms:templates_version')
+    except Exception as e:
+        log(e)
+
+
+def get_patient_info(medsenger_api, contract_id, fresh=False):
+    key = 'forms:patient_info:{}'.format(contract_id)
+
+    try:
+        if not fresh:
+            cached = get_redis().get(key)
+            if cached:
+                get_redis().hincrby('forms:patient_info:stats', 'hits')
+                return json.loads(cached)
+
+        get_redis().hincrby('forms:patient_info:stats', 'misses')
+    except Exception as e:
+        log(e)
+        return medsenger_api.get_patient_info(contract_id)
+
+    info = medsenger_api.get_patient_info(contract_id)
+
+    if isinstance(info, dict) and info:
+        try:
+            get_redis().set(key, json.dumps(info), ex=PATIENT_INFO_TTL)
+        except Exception as e:
+            log(e)
+
+    return info
+
+
+def invalidate_patient_info(contract_id):
+    try:
+        get_redis().delete('forms:patient_info:{}'.format(contract_id))
+    except Exception as e:
+        log(e)
+
+
+def get_patient_info_stats():
+    try:
+        stats = get_redis().hgetall('forms:patient_info:stats')
+    except Exception as e:
+        log(e)
+        stats = {}
+
+    hits = int(stats.get(b'hits', 0))
+    misses = int(stats.get(b'misses', 0))
+
+    return {
+        "hits": hits,
+        "misses": misses,
+        "saved_calls": hits,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None
+    }
+
+
 def fullfill_message(text, contract, medsenger_api):
     def fullfill(text, info, a, b):
         L = b.split('.')
@@ -238,7 +367,7 @@ def fullfill_message(text, contract, medsenger_api):
     for key in keys:
         if key in text:
             if not info:
-                info = medsenger_api.get_patient_info(contract.id)
+                info = get_patient_info(medsenger_api, contract.id)
             text = fullfill(text, info, key, keys[key])
 
     if 'CONTRACT_DESCRIPTION' in text:
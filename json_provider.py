@@ -0,0 +1,45 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # dates go through Flask's default so responses keep the same date format as before
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(self, obj, sort_keys=None):
+        if sort_keys is None:
+            sort_keys = self.sort_keys
+
+        return orjson.dumps(obj, default=self.default, option=self.option | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs) - {'sort_keys'}:
+            return super().dumps(obj, **kwargs)
+
+        try:
+            return self.dumps_bytes(obj, kwargs.get('sort_keys')).decode()
+        except orjson.JSONEncodeError:
+            # integers over 64 bits and other values orjson rejects
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super().loads(s)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+
+        try:
+            body = self.dumps_bytes(obj) + b"\n"
+        except orjson.JSONEncodeError:
+            body = super().dumps(obj) + "\n"
+
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -1,21 +1,29 @@
+import click
 from celery import Celery
 from flask import Flask
 from flask_compress import Compress
 from flask_cors import CORS
 
-from models import db
+from json_provider import OrjsonProvider
+from models import db, ComplianceRollup
 from flask_migrate import Migrate
 from sentry_sdk.integrations.flask import FlaskIntegration
 import sentry_sdk
 from managers.AlgorithmManager import AlgorithmManager
+from managers.ArchiveManager import ArchiveManager, is_partition_table
+from managers.CatalogManager import CatalogManager, MODELS
+from managers.CategoryManager import CategoryManager
+from managers.ComplianceManager import ComplianceManager
 from managers.ContractsManager import ContractManager
 from managers.FormManager import FormManager
 from managers.MedicineManager import MedicineManager
+from managers.OutboxManager import OutboxManager
 from managers.ReminderManager import ReminderManager
 from managers.TimetableManager import TimetableManager
 from managers.MedicineTemplateManager import MedicineTemplateManager
 from managers.ExaminationManager import ExaminationManager
 from medsenger_api import AgentApiClient
+from outbox import OutboxClient
 
 from config import *
 
@@ -27,6 +35,7 @@ if PRODUCTION:
     )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 CORS(app)
 Compress(app)
@@ -37,7 +46,13 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_pre_ping": True}
 
 db.init_app(app)
 
-migrate = Migrate(app, db)
+
+def include_object(object, name, type_, reflected, compare_to):
+    # monthly action_request partitions are managed by ArchiveManager, not by migrations
+    return not (type_ == 'table' and reflected and is_partition_table(name))
+
+
+migrate = Migrate(app, db, include_object=include_object)
 
 celery = Celery(
     __name__,
@@ -47,6 +62,8 @@ celery = Celery(
 
 
 medsenger_api = AgentApiClient(API_KEY, MAIN_HOST, AGENT_ID, API_DEBUG, use_grpc=USE_GRPC, grpc_host=GRPC_HOST, sentry_dsn=SENTRY)
+outbox = OutboxClient(medsenger_api, db)
+outbox_manager = OutboxManager(medsenger_api, db)
 contract_manager = ContractManager(medsenger_api, db)
 form_manager = FormManager(medsenger_api, db)
 medicine_manager = MedicineManager(medsenger_api, db)
@@ -55,3 +72,31 @@ timetable_manager = TimetableManager(medicine_manager, form_manager, reminder_ma
 examination_manager = ExaminationManager(medsenger_api, db)
 algorithm_manager = AlgorithmManager(medsenger_api, db)
 medicine_template_manager = MedicineTemplateManager(medsenger_api, db)
+compliance_manager = ComplianceManager(medsenger_api, db)
+archive_manager = ArchiveManager(medsenger_api, db)
+category_manager = CategoryManager(medsenger_api, db)
+catalog_manager = CatalogManager(medsenger_api, db, {
+    "forms": form_manager,
+    "medicines": medicine_manager,
+    "reminders": reminder_manager,
+    "algorithms": algorithm_manager,
+    "examinations": examination_manager
+})
+
+
+@app.cli.command('rebuild-compliance')
+@click.option('--if-empty', is_flag=True, help="Only build the rollup if it has no rows yet.")
+def rebuild_compliance(if_empty):
+    if if_empty and ComplianceRollup.query.first():
+        print("Compliance rollup is already built")
+        return
+
+    print("Compliance rollup rebuilt: {} rows".format(compliance_manager.rebuild()))
+
+
+@app.cli.command('partition-action-requests')
+def partition_action_requests():
+    if archive_manager.convert():
+        print("action_request is now partitioned by month")
+    else:
+        print("Nothing to do: action_request is already partitioned or the database is not postgres")
@@ -1,24 +1,22 @@
 import json
-import re
 import time
 from copy import deepcopy
 from datetime import datetime, timedelta
 
-import medsenger_api
-import requests
-
 from config import DYNAMIC_CACHE
 
+from sqlalchemy import or_
 from sqlalchemy.orm.attributes import flag_modified, flag_dirty
 
 from helpers import log, generate_event_description, DATACACHE, timezone_now, localize, fullfill_message, \
-    clear_categories
+    clear_categories, bump_templates_version
+from managers.CategoryManager import CategoryManager
 from managers.ContractsManager import ContractManager
 from managers.FormManager import FormManager
 from managers.HookManager import HookManager
 from managers.Manager import Manager
 from managers.MedicineManager import MedicineManager
-from models import Algorithm
+from models import Algorithm, Contract
 
 
 class AlgorithmManager(Manager):
@@ -26,6 +24,7 @@ class AlgorithmManager(Manager):
         super(AlgorithmManager, self).__init__(*args)
 
         self.__hook_manager = HookManager(self.medsenger_api, self.db)
+        self.category_manager = CategoryManager(self.medsenger_api, self.db)
 
     def get(self, algorithm_id):
         return Algorithm.query.filter_by(id=algorithm_id).first()
@@ -46,11 +45,13 @@ class AlgorithmManager(Manager):
             'algorithm_titles': list(map(lambda a: a.title, algorithms))
         }
 
-        self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                      'Отключены алгоритмы', params=params)
+        self.outbox.add_record(contract.id, 'doctor_action',
+                               'Отключены алгоритмы', params=params)
 
         if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract.id)
+            self.outbox.update_cache(contract.id)
+
+        self.__commit__()
 
     def attach(self, template_id, contract, setup=None):
         algorithm = self.get(template_id)
@@ -108,8 +109,9 @@ class AlgorithmManager(Manager):
                 'object_type': 'algorithm',
                 'params': new_algorithm.get_params()
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Подключен алгоритм "{}"'.format(new_algorithm.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Подключен алгоритм "{}"'.format(new_algorithm.title), params=params)
+            self.__commit__()
 
             return True
         else:
@@ -125,8 +127,9 @@ class AlgorithmManager(Manager):
             'action': 'clear',
             'object_type': 'algorithm'
         }
-        self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                      'Отключены все алгоритмы.', params=params)
+        self.outbox.add_record(contract.id, 'doctor_action',
+                               'Отключены все алгоритмы.', params=params)
+        self.__commit__()
 
         return True
 
@@ -143,17 +146,22 @@ class AlgorithmManager(Manager):
 
         self.__commit__()
 
+        if algorithm.is_template:
+            bump_templates_version()
+
         params = {
             'obj_id': algorithm.id,
             'action': 'detach',
             'object_type': 'algorithm'
         }
 
-        self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                      'Отключен алгоритм "{}".'.format(algorithm.title), params=params)
+        self.outbox.add_record(contract.id, 'doctor_action',
+                               'Отключен алгоритм "{}".'.format(algorithm.title), params=params)
 
         if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract.id)
+            self.outbox.update_cache(contract.id)
+
+        self.__commit__()
 
         return id
 
@@ -189,6 +197,134 @@ class AlgorithmManager(Manager):
 
         return value
 
+    def get_windows(self, criteria):
+        # the record windows check_criteria asks get_values for, as (category, dimension, hours, times, offset)
+        windows = []
+        mode = criteria.get('left_mode')
+
+        if mode in ['step_init', 'init', 'time']:
+            return windows
+
+        sides = [(criteria.get('category'), mode, criteria.get('left_dimension'), criteria.get('left_hours'),
+                  criteria.get('left_times'), criteria.get('left_offset_dimension', 'times'),
+                  criteria.get('left_offset', 0))]
+
+        if criteria.get('right_mode') != 'value':
+            dimension = criteria.get('right_dimension')
+            sides.append((criteria.get('right_category') or criteria.get('category'), criteria.get('right_mode'),
+                          dimension if dimension == 'hours' else 'times', criteria.get('right_hours'),
+                          criteria.get('right_times'), criteria.get('right_offset_dimension', 'times'),
+                          criteria.get('right_offset', 0)))
+
+        for category_name, mode, dimension, hours, times, offset_dim, offset_count in sides:
+            if mode in ['value', 'category_value'] or not category_name:
+                continue
+
+            if dimension not in ['hours', 'times']:
+                dimension, hours = 'hours', (criteria.get('left_for') or 0) * 24
+
+            try:
+                if dimension == 'hours':
+                    windows.append((category_name, 'hours', float(hours), None,
+                                    int(offset_count or 0) if offset_dim == 'times' else 0))
+                elif offset_dim == 'times' or not offset_count:
+                    windows.append((category_name, 'times', None, int(times), int(offset_count or 0)
+                                    if offset_dim == 'times' else 0))
+            except (TypeError, ValueError):
+                continue
+
+        return windows
+
+    def prefetch_records(self, contract_id, criteria_list):
+        # one request per category and window kind, get_values slices the series locally
+        hours, times = {}, {}
+
+        for criteria in criteria_list:
+            for category_name, dimension, window_hours, window_times, offset in self.get_windows(criteria):
+                if category_name in ['exact_date', 'contract_start_date', 'contract_end_date',
+                                     'algorithm_attach_date', 'algorithm_detach_date']:
+                    continue
+
+                if dimension == 'hours':
+                    hours[category_name] = max(hours.get(category_name, 0), window_hours)
+                else:
+                    times[category_name] = max(times.get(category_name, 0), window_times + offset)
+
+        now = datetime.now()
+
+        for category_name, window_hours in hours.items():
+            if self.get_from_cache(('records_since', category_name, contract_id)):
+                continue
+
+            time_from = int((now - timedelta(hours=window_hours)).timestamp())
+            answer = self.medsenger_api.get_records(contract_id, category_name, time_from=time_from)
+
+            if answer and 'values' in answer:
+                self.save_to_cache(('records_since', category_name, contract_id), (time_from, answer))
+
+        for category_name, limit in times.items():
+            if not limit or self.get_from_cache(('records_last', category_name, contract_id)):
+                continue
+
+            answer = self.medsenger_api.get_records(contract_id, category_name, limit=limit,
+                                                    time_to=int(now.timestamp()))
+
+            if answer and 'values' in answer:
+                self.save_to_cache(('records_last', category_name, contract_id), (limit, answer))
+
+    def get_planned_records(self, category_name, contract_id, dimension, hours, times, offset_dim, offset_count):
+        try:
+            offset = int(offset_count or 0) if offset_dim == 'times' else 0
+        except (TypeError, ValueError):
+            return None
+
+        if dimension == 'hours':
+            planned = self.get_from_cache(('records_since', category_name, contract_id))
+
+            if not planned:
+                return None
+
+            time_from, answer = planned
+            since = int((datetime.now() - timedelta(hours=hours)).timestamp())
+            values = answer['values']
+
+            if since < time_from or (offset and not self.is_newest_first(values)):
+                return None
+
+            return {"values": [value for value in values if int(value['timestamp']) >= since][offset:]}
+
+        planned = self.get_from_cache(('records_last', category_name, contract_id))
+
+        if not planned or (offset_dim != 'times' and offset_count):
+            return None
+
+        limit, answer = planned
+        values = answer['values']
+
+        try:
+            times = int(times)
+        except (TypeError, ValueError):
+            return None
+
+        if times + offset > limit:
+            return None
+
+        timestamps = [int(value['timestamp']) for value in values]
+
+        if len(set(timestamps)) == 1 and len(values) > 1:
+            return None
+        if self.is_newest_first(values):
+            return {"values": values[offset:offset + times]}
+        # an offset is only unambiguous when the series is newest first
+        if not offset and all(a <= b for a, b in zip(timestamps, timestamps[1:])):
+            return {"values": values[-times:]}
+
+        return None
+
+    def is_newest_first(self, values):
+        timestamps = [int(value['timestamp']) for value in values]
+        return all(a >= b for a, b in zip(timestamps, timestamps[1:]))
+
     def get_values(self, category_name, mode, contract_id, dimension='hours', hours=1, times=1, algorithm=None,
                    offset_dim='times', offset_count=0, check_value=None, sign=None, zone=None):
         k = (category_name, mode, contract_id, dimension, hours, times, offset_dim, offset_count)
@@ -199,9 +335,9 @@ class AlgorithmManager(Manager):
         if category_name == "exact_date":
             return [datetime.now().strftime("%Y-%m-%d")], None
         if category_name == "contract_start_date":
-            return self.save_to_cache(k, ([self.medsenger_api.get_patient_info(contract_id).get('start_date')], None))
+            return self.save_to_cache(k, ([self.get_patient_info(contract_id).get('start_date')], None))
         if category_name == "contract_end_date":
-            return self.save_to_cache(k, ([self.medsenger_api.get_patient_info(contract_id).get('end_date')], None))
+            return self.save_to_cache(k, ([self.get_patient_info(contract_id).get('end_date')], None))
 
         if category_name == "algorithm_attach_date" and algorithm:
             if algorithm.attach_date:
@@ -217,6 +353,10 @@ class AlgorithmManager(Manager):
         if mode == 'value' or mode == 'category_value':
             answer = self.medsenger_api.get_records(contract_id, category_name, group=True, limit=1)
         else:
+            answer = self.get_planned_records(category_name, contract_id, dimension, hours, times, offset_dim,
+                                              offset_count)
+
+        if answer is None and mode not in ['value', 'category_value']:
             time_from = datetime.now() - timedelta(hours=hours)
             time_to = datetime.now()
             offset = 0
@@ -496,12 +636,13 @@ class AlgorithmManager(Manager):
 
                 params["message"] = params.get("message", "") + report
 
-            self.medsenger_api.send_order(contract.id, order, agent_id, params)
+            self.outbox.send_order(contract.id, order, agent_id, params)
 
         if action['type'] == 'patient_public_attachment':
             criteria = action['params'].get('criteria')
             comment = action['params'].get('text')
-            info = self.medsenger_api.get_patient_info(contract.id)
+            # attachments change outside of contract events, so this one goes upstream
+            info = self.get_patient_info(contract.id, fresh=True)
 
             attachments = []
 
@@ -511,27 +652,18 @@ class AlgorithmManager(Manager):
 
             if attachments:
                 has_message_to_patient = True
-                self.medsenger_api.send_message(contract.id, comment,
-                                                only_patient=True,
-                                                action_deadline=int(time.time()) + 60 * 60, attachments=attachments)
+                self.outbox.send_message(contract.id, comment,
+                                         only_patient=True,
+                                         action_deadline=int(time.time()) + 60 * 60, attachments=attachments)
 
         if action['type'] == 'send_file_by_link':
             link = action['params'].get('link')
             text = action['params'].get('text')
 
             if link:
-                try:
-                    answer = requests.get(link)
-                    if "Content-Disposition" in answer.headers.keys():
-                        fname = re.findall("filename=(.+)", answer.headers["Content-Disposition"])[0]
-                    else:
-                        fname = link.split("/")[-1]
-                    has_message_to_patient = True
-                    self.medsenger_api.send_message(contract.id, text, only_patient=True,
-                                                    attachments=[medsenger_api.prepare_binary(fname, answer.content)])
-
-                except Exception as e:
-                    log(e, False)
+                # the file is downloaded by the sender, only the link is stored in the outbox
+                has_message_to_patient = True
+                self.outbox.send_file_by_link(contract.id, link, text)
 
         if action['type'] == 'patient_message':
             has_message_to_patient = True
@@ -553,10 +685,10 @@ class AlgorithmManager(Manager):
             if is_warning:
                 is_urgent = "warning"
 
-            self.medsenger_api.send_message(contract.id, action['params']['text'] + report,
-                                            only_patient=True, action_name=action_name, action_link=action_link,
-                                            is_urgent=is_urgent,
-                                            action_deadline=action_deadline)
+            self.outbox.send_message(contract.id, action['params']['text'] + report,
+                                     only_patient=True, action_name=action_name, action_link=action_link,
+                                     is_urgent=is_urgent,
+                                     action_deadline=action_deadline)
         if action['type'] == 'doctor_message':
             if action['params'].get('add_action'):
                 action_name = action['params'].get('action_name')
@@ -576,12 +708,12 @@ class AlgorithmManager(Manager):
             if is_warning:
                 is_urgent = "warning"
 
-            self.medsenger_api.send_message(contract.id, fullfill_message(action['params']['text'] + report, contract,
+            self.outbox.send_message(contract.id, fullfill_message(action['params']['text'] + report, contract,
                                                                           self.medsenger_api),
-                                            only_doctor=True, action_name=action_name, action_link=action_link,
-                                            is_urgent=is_urgent,
-                                            need_answer=action['params'].get('need_answer'),
-                                            action_deadline=action_deadline)
+                                     only_doctor=True, action_name=action_name, action_link=action_link,
+                                     is_urgent=is_urgent,
+                                     need_answer=action['params'].get('need_answer'),
+                                     action_deadline=action_deadline)
         if action['type'] == 'record':
             category_name = action['params'].get('category')
             value = action['params'].get('value')
@@ -592,14 +724,14 @@ class AlgorithmManager(Manager):
             name = action['params'].get('medicine_name')
             rules = action['params'].get('medicine_rules')
 
-            self.medsenger_api.send_message(contract.id,
-                                            'Внимание! В соответствие с алгоритмом, Вам требуется дополнительное принять препарат {}.<br>Комментарий: {}.'.format(
+            self.outbox.send_message(contract.id,
+                                     'Внимание! В соответствие с алгоритмом, Вам требуется дополнительное принять препарат {}.<br>Комментарий: {}.'.format(
                                                 name, rules), only_patient=True,
-                                            is_urgent="warning")
-            self.medsenger_api.send_message(contract.id,
-                                            'Внимание! В соответствие с алгоритмом, пациенту отправлена просьба принять препарат {}.<br>Комментарий: {}.'.format(
+                                     is_urgent="warning")
+            self.outbox.send_message(contract.id,
+                                     'Внимание! В соответствие с алгоритмом, пациенту отправлена просьба принять препарат {}.<br>Комментарий: {}.'.format(
                                                 name, rules), only_doctor=True,
-                                            is_urgent="warning")
+                                     is_urgent="warning")
         if action['type'] in ['form', 'attach_form', 'detach_form', 'attach_algorithm', 'detach_algorithm',
                               'attach_medicine', 'detach_medicine']:
             form_manager = FormManager(self.medsenger_api, self.db)
@@ -620,36 +752,36 @@ class AlgorithmManager(Manager):
 
                 if form:
                     form_manager.attach(template_id, contract)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Опросник {} автоматически подключен.'.format(form.title),
-                                                    only_doctor=True)
+                    self.outbox.send_message(contract.id,
+                                             'Опросник {} автоматически подключен.'.format(form.title),
+                                             only_doctor=True)
 
             if action['type'] == 'detach_form':
                 form = form_manager.get(template_id)
 
                 if form:
                     form_manager.detach(template_id, contract)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Опросник {} автоматически отключен.'.format(form.title),
-                                                    only_doctor=True)
+                    self.outbox.send_message(contract.id,
+                                             'Опросник {} автоматически отключен.'.format(form.title),
+                                             only_doctor=True)
 
             if action['type'] == 'attach_algorithm':
                 algorithm = self.get(template_id)
 
                 if algorithm:
                     self.attach(template_id, contract)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Алгоритм {} автоматически подключен.'.format(algorithm.title),
-                                                    only_doctor=True)
+                    self.outbox.send_message(contract.id,
+                                             'Алгоритм {} автоматически подключен.'.format(algorithm.title),
+                                             only_doctor=True)
 
             if action['type'] == 'detach_algorithm':
                 algorithm = self.get(template_id)
 
                 if algorithm:
                     self.detach(template_id, contract)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Алгоритм {} автоматически отключен.'.format(algorithm.title),
-                                                    only_doctor=True)
+                    self.outbox.send_message(contract.id,
+                                             'Алгоритм {} автоматически отключен.'.format(algorithm.title),
+                                             only_doctor=True)
 
             if action['type'] == 'attach_medicine':
                 medicine = medicine_manager.get(template_id)
@@ -659,11 +791,11 @@ class AlgorithmManager(Manager):
                     # self.medsenger_api.send_message(contract_id, 'Вам назначен препарат {} ({} / {}).'.format(
                     #    medicine.title, medicine.rules, medicine.timetable_description()),
                     #                               only_patient=True)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Внимание! Препарат {} ({} / {}) назначен автоматически.'.format(
+                    self.outbox.send_message(contract.id,
+                                             'Внимание! Препарат {} ({} / {}) назначен автоматически.'.format(
                                                         medicine.title, medicine.rules,
                                                         medicine.timetable_description()),
-                                                    only_doctor=True)
+                                             only_doctor=True)
 
             if action['type'] == 'detach_medicine':
                 medicine = medicine_manager.get(template_id)
@@ -671,14 +803,14 @@ class AlgorithmManager(Manager):
                 if medicine:
                     medicine_manager.detach(template_id, contract)
 
-                    self.medsenger_api.send_message(contract.id, 'Препарат {} ({} / {}) отменен.'.format(
+                    self.outbox.send_message(contract.id, 'Препарат {} ({} / {}) отменен.'.format(
                         medicine.title, medicine.rules, medicine.timetable_description()),
-                                                    only_patient=True)
-                    self.medsenger_api.send_message(contract.id,
-                                                    'Внимание! Препарат {} ({} / {}) отменен автоматически.'.format(
+                                             only_patient=True)
+                    self.outbox.send_message(contract.id,
+                                             'Внимание! Препарат {} ({} / {}) отменен автоматически.'.format(
                                                         medicine.title, medicine.rules,
                                                         medicine.timetable_description()),
-                                                    only_doctor=True)
+                                             only_doctor=True)
         if action['type'] == 'script':
             form_manager = FormManager(self.medsenger_api, self.db)
             contract_manager = ContractManager(self.medsenger_api, self.db)
@@ -744,18 +876,29 @@ class AlgorithmManager(Manager):
                     self.run_action(action, algorithm.contract, [], algorithm)
         self.__commit__()
 
-    def check_timeouts(self, app):
+    def check_timeouts(self, app, shard=None, shards=1):
         with app.app_context():
-            algorithms = list(Algorithm.query.filter((Algorithm.contract_id != None) & (Algorithm.timeout_at != 0) & (
-                    Algorithm.timeout_at < time.time())).all())
+            query = Algorithm.query.filter((Algorithm.contract_id != None) & (Algorithm.timeout_at != 0) & (
+                    Algorithm.timeout_at < time.time()))
+
+            if shard is not None:
+                query = query.filter(Algorithm.contract_id % shards == shard)
+
+            algorithms = list(query.all())
 
             for algorithm in algorithms:
                 self.timeout(algorithm)
 
-    def check_detach_dates(self, app):
+    def check_detach_dates(self, app, hour=3):
         with app.app_context():
-            algorithms = list(Algorithm.query.filter(
-                (Algorithm.detach_date == datetime.now().date()) & (Algorithm.is_template == False)).all())
+            zones = self.get_local_zones(hour)
+
+            if not zones:
+                return
+
+            algorithms = list(Algorithm.query.join(Contract, Contract.id == Algorithm.contract_id).filter(
+                or_(*[condition & (Algorithm.detach_date == day) for condition, day in zones]) &
+                (Algorithm.is_template == False)).all())
 
             for algorithm in algorithms:
                 self.db.session.delete(algorithm)
@@ -784,6 +927,11 @@ class AlgorithmManager(Manager):
         if algorithm.common_conditions:
             additional_conditions = algorithm.common_conditions
 
+        self.prefetch_records(contract.id, [criteria for condition in additional_conditions + current_step['conditions']
+                                            for group in condition['criteria']
+                                            if self.__should_observe_group(group, included_types, excluded_types)
+                                            for criteria in group])
+
         for condition in additional_conditions + current_step['conditions']:
             bypass = False
 
@@ -798,8 +946,7 @@ class AlgorithmManager(Manager):
 
             additions = []
             descriptions = []
-            category_names = {category['name']: category['description'] for category in
-                              self.medsenger_api.get_categories()}
+            category_names = self.category_manager.get_names()
 
             or_groups = [group for group in criteria if
                          self.__should_observe_group(group, included_types, excluded_types)]
@@ -811,11 +958,10 @@ class AlgorithmManager(Manager):
 
             if result:
                 if not condition.get('skip_additions'):
-                    for addition in additions:
-                        self.medsenger_api.send_addition(contract.id, addition['id'], {
-                            "algorithm_id": algorithm.id,
-                            "comment": addition["comment"]
-                        })
+                    self.gather(('send_addition', (contract.id, addition['id'], {
+                        "algorithm_id": algorithm.id,
+                        "comment": addition["comment"]
+                    })) for addition in additions)
                 fired = True
 
                 if not bypass:
@@ -826,16 +972,17 @@ class AlgorithmManager(Manager):
             else:
                 for action in condition.get('negative_actions', []):
                     self.run_action(action, contract, descriptions, algorithm)
-        if fired:
-            try:
+        if DYNAMIC_CACHE:
+            self.outbox.update_cache(contract.id)
+
+        # actions queue their messages in the session, so it is committed even when nothing fired
+        try:
+            if fired:
                 flag_modified(algorithm, "steps")
                 flag_modified(algorithm, "common_conditions")
-                self.__commit__()
-            except Exception as e:
-                log(e, False)
-
-        if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract.id)
+            self.__commit__()
+        except Exception as e:
+            log(e, False)
 
         return fired, has_message_to_patient
 
@@ -897,8 +1044,9 @@ class AlgorithmManager(Manager):
             has_message_to_patient = has_message_to_patient or has_message
 
         if not has_message_to_patient and form.thanks_text:
-            self.medsenger_api.send_message(contract.id, text=form.thanks_text, only_patient=True,
-                                            action_deadline=time.time() + 60 * 60)
+            self.outbox.send_message(contract.id, text=form.thanks_text, only_patient=True,
+                                     action_deadline=time.time() + 60 * 60)
+            self.__commit__()
 
         self.clear_cache(contract.id)
         return True
@@ -917,8 +1065,7 @@ class AlgorithmManager(Manager):
         return True
 
     def check_inits(self, algorithm, contract):
-        category_names = {category['name']: category['description'] for category in
-                          self.medsenger_api.get_categories()}
+        category_names = self.category_manager.get_names()
 
         if not algorithm.common_conditions:
             algorithm.common_conditions = []
@@ -992,6 +1139,9 @@ class AlgorithmManager(Manager):
 
             self.__commit__()
 
+            if algorithm.is_template:
+                bump_templates_version()
+
             if not data.get('is_template'):
                 params = {
                     'obj_id': algorithm.id,
@@ -999,8 +1149,8 @@ class AlgorithmManager(Manager):
                     'object_type': 'algorithm',
                     'algorithm_params': algorithm.get_params()
                 }
-                self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                              '{} алгоритм "{}".'.format('Изменен' if algorithm_id else 'Подключен',
+                self.outbox.add_record(contract.id, 'doctor_action',
+                                       '{} алгоритм "{}".'.format('Изменен' if algorithm_id else 'Подключен',
                                                                          algorithm.title), params=params)
 
             if algorithm.contract_id == contract.id:
@@ -1017,7 +1167,9 @@ class AlgorithmManager(Manager):
                 self.__hook_manager.create_hooks_after_creation(algorithm)
 
             if DYNAMIC_CACHE:
-                self.medsenger_api.update_cache(contract.id)
+                self.outbox.update_cache(contract.id)
+
+            self.__commit__()
 
             return algorithm
         except Exception as e:
@@ -0,0 +1,215 @@
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text, func
+
+from config import ACTION_REQUEST_RETENTION_MONTHS
+from helpers import log
+from managers.ComplianceManager import ComplianceManager
+from managers.Manager import Manager
+from models import ActionRequest, ActionRequestArchive
+
+PARTITION = re.compile(r'^action_request_y(\d{4})m(\d{2})$')
+COLUMNS = 'id, contract_id, action, description, is_done, sent, done'
+
+
+def month_start(day, offset=0):
+    month = day.year * 12 + day.month - 1 + offset
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def is_partition_table(name):
+    return bool(PARTITION.match(name)) or name in ['action_request_default', 'action_request_unpartitioned']
+
+
+class ArchiveManager(Manager):
+    def __init__(self, *args):
+        super(ArchiveManager, self).__init__(*args)
+        self.compliance_manager = ComplianceManager(*args)
+
+    def is_partitioned(self):
+        if self.db.engine.dialect.name != 'postgresql':
+            return False
+
+        return bool(self.db.session.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('action_request')")).scalar())
+
+    def partition_name(self, month):
+        return 'action_request_y{}m{:02d}'.format(month.year, month.month)
+
+    def get_detached(self):
+        # months whose partition was detached by an earlier run that did not get to drop it
+        names = self.db.session.execute(text(
+            "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+            "AND relname LIKE 'action\\_request\\_y%'")).scalars()
+        detached = {}
+
+        for name in names:
+            match = PARTITION.match(name)
+            if match:
+                detached[date(int(match.group(1)), int(match.group(2)), 1)] = name
+
+        return detached
+
+    def get_partitions(self):
+        names = self.db.session.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'action_request'::regclass")).scalars()
+        partitions = {}
+
+        for name in names:
+            match = PARTITION.match(name)
+            if match:
+                partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+
+        return partitions
+
+    def create_partition(self, month):
+        name = self.partition_name(month)
+        bounds = {"start": month, "end": month_start(month, 1)}
+        execute = lambda sql, params=None: self.db.session.execute(text(sql), params or {})
+
+        if execute("SELECT to_regclass(:name)", {"name": name}).scalar():
+            return
+
+        # postgres refuses the new range while the default partition holds rows from it, so they are moved over
+        stray = execute("SELECT to_regclass('action_request_default')").scalar() and execute(
+            "SELECT 1 FROM action_request_default WHERE sent >= :start AND sent < :end LIMIT 1", bounds).scalar()
+
+        if stray:
+            execute("ALTER TABLE action_request DETACH PARTITION action_request_default")
+
+        execute("CREATE TABLE {} PARTITION OF action_request FOR VALUES FROM ('{}') TO ('{}')".format(
+            name, bounds['start'], bounds['end']))
+
+        if stray:
+            execute("INSERT INTO {0} ({1}) SELECT {1} FROM action_request_default "
+                    "WHERE sent >= :start AND sent < :end".format(name, COLUMNS), bounds)
+            execute("DELETE FROM action_request_default WHERE sent >= :start AND sent < :end", bounds)
+            execute("ALTER TABLE action_request ATTACH PARTITION action_request_default DEFAULT")
+
+    def ensure_partitions(self, months_ahead=2):
+        today = date.today()
+
+        for offset in range(months_ahead + 1):
+            try:
+                self.create_partition(month_start(today, offset))
+                self.__commit__()
+            except Exception as e:
+                self.db.session.rollback()
+                log(e, True)
+
+    def archive(self, app):
+        with app.app_context():
+            cutoff = month_start(date.today(), -ACTION_REQUEST_RETENTION_MONTHS)
+
+            if self.is_partitioned():
+                self.archive_partitions(cutoff)
+            else:
+                self.archive_rows(cutoff)
+
+    def archive_partitions(self, cutoff):
+        self.ensure_partitions()
+
+        # the month is copied while the partition is still attached and detached concurrently afterwards,
+        # so action_request is never locked for the duration of the copy
+        for month, name in sorted(self.get_partitions().items()):
+            if month >= cutoff:
+                continue
+
+            try:
+                self.copy_to_archive(name)
+                self.__commit__()
+                self.detach_partition(name)
+            except Exception as e:
+                self.db.session.rollback()
+                log(e, True)
+
+        for month, name in sorted(self.get_detached().items()):
+            if month >= cutoff:
+                continue
+
+            try:
+                # picks up the rows updated between the first copy and the detach
+                self.copy_to_archive(name)
+                self.compliance_manager.rebuild(month, month_start(month, 1), [ActionRequestArchive.__table__],
+                                                commit=False)
+                self.db.session.execute(text("DROP TABLE {}".format(name)))
+                self.__commit__()
+            except Exception as e:
+                self.db.session.rollback()
+                log(e, True)
+
+    def copy_to_archive(self, name):
+        # an upsert, so copying a month again never duplicates it
+        self.db.session.execute(text(
+            "INSERT INTO action_request_archive ({0}) SELECT {0} FROM {1} "
+            "ON CONFLICT (id) DO UPDATE SET is_done = excluded.is_done, done = excluded.done".format(COLUMNS, name)))
+
+    def detach_partition(self, name):
+        # concurrent detach and its finalize cannot run in a transaction block
+        pending = self.db.session.execute(text(
+            "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:name)"), {"name": name}).scalar()
+        self.db.session.rollback()
+
+        with self.db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("ALTER TABLE action_request DETACH PARTITION {} {}".format(
+                name, "FINALIZE" if pending else "CONCURRENTLY")))
+
+    def archive_rows(self, cutoff):
+        oldest = self.db.session.query(func.min(ActionRequest.sent)).scalar()
+
+        if not oldest or oldest.date() >= cutoff:
+            return
+
+        try:
+            self.compliance_manager.rebuild(month_start(oldest), cutoff,
+                                            [ActionRequest.__table__, ActionRequestArchive.__table__], commit=False)
+            self.db.session.execute(text(
+                "INSERT INTO action_request_archive ({0}) SELECT {0} FROM action_request WHERE sent < :cutoff".format(
+                    COLUMNS)), {"cutoff": cutoff})
+            ActionRequest.query.filter(ActionRequest.sent < cutoff).delete()
+            self.__commit__()
+        except Exception as e:
+            self.db.session.rollback()
+            log(e, True)
+
+    def convert(self):
+        # one-off: turns action_request into a table partitioned by month of sent, postgres only
+        if self.db.engine.dialect.name != 'postgresql' or self.is_partitioned():
+            return False
+
+        execute = lambda sql: self.db.session.execute(text(sql))
+
+        oldest, newest = self.db.session.query(func.min(ActionRequest.sent), func.max(ActionRequest.sent)).one()
+        today = datetime.now()
+
+        execute("ALTER SEQUENCE action_request_id_seq OWNED BY NONE")
+        execute("ALTER TABLE action_request RENAME TO action_request_unpartitioned")
+        execute("ALTER TABLE action_request_unpartitioned RENAME CONSTRAINT action_request_pkey "
+                "TO action_request_unpartitioned_pkey")
+
+        for index in ActionRequest.__table__.indexes:
+            execute("DROP INDEX IF EXISTS {}".format(index.name))
+
+        execute("CREATE TABLE action_request (LIKE action_request_unpartitioned INCLUDING DEFAULTS, "
+                "PRIMARY KEY (id, sent), FOREIGN KEY (contract_id) REFERENCES contract (id) ON DELETE CASCADE) "
+                "PARTITION BY RANGE (sent)")
+        execute("ALTER SEQUENCE action_request_id_seq OWNED BY action_request.id")
+        execute("CREATE TABLE action_request_default PARTITION OF action_request DEFAULT")
+
+        month = month_start(min(oldest or today, today))
+        last = month_start(max(newest or today, today), 2)
+        while month <= last:
+            self.create_partition(month)
+            month = month_start(month, 1)
+
+        for index in ActionRequest.__table__.indexes:
+            index.create(self.db.session.connection())
+
+        execute("INSERT INTO action_request ({0}) SELECT id, contract_id, action, description, is_done, "
+                "coalesce(sent, done, now()), done FROM action_request_unpartitioned".format(COLUMNS))
+        execute("DROP TABLE action_request_unpartitioned")
+        self.__commit__()
+
+        return True
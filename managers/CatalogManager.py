@@ -0,0 +1,181 @@
+import gzip
+import hashlib
+import re
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import or_
+
+from helpers import get_templates_version, TEMPLATES_VERSION, log
+from managers.Manager import Manager
+from models import Form, Medicine, Reminder, Algorithm, MedicalExamination
+
+MODELS = {
+    "forms": Form,
+    "medicines": Medicine,
+    "reminders": Reminder,
+    "algorithms": Algorithm,
+    "examinations": MedicalExamination
+}
+
+# reminders have no title or category, their search goes over the text
+SEARCH_COLUMNS = {
+    "reminders": ['text'],
+}
+
+# without redis the version is unknown, so the catalog is only trusted for a short while
+UNVERSIONED_TTL = 60
+MAX_AGE = 600
+
+
+def clinic_ids(value):
+    # clinics are typed in by hand in the editors, so they may be a list, a number or a string of ids
+    if isinstance(value, list):
+        return {str(item).strip() for item in value}
+
+    return set(re.findall(r'\d+', str(value)))
+
+
+class CatalogManager(Manager):
+    def __init__(self, medsenger_api, db, managers):
+        super(CatalogManager, self).__init__(medsenger_api, db)
+        self.managers = managers
+        self.catalog = None
+        self.lock = threading.Lock()
+
+    def is_fresh(self, catalog, version):
+        if not catalog or catalog['local'] != TEMPLATES_VERSION['local']:
+            return False
+
+        age = time.time() - catalog['built']
+
+        if version is None:
+            return age < UNVERSIONED_TTL
+
+        return catalog['version'] == version and age < MAX_AGE
+
+    def build(self, version):
+        local = TEMPLATES_VERSION['local']
+        templates = {name: manager.get_templates_as_dicts() for name, manager in self.managers.items()}
+        body = current_app.json.dumps(templates).encode() + b"\n"
+
+        return {
+            "version": version,
+            "local": local,
+            "built": time.time(),
+            "body": body,
+            "gzipped": gzip.compress(body, 6),
+            "etag": hashlib.sha1(body).hexdigest()
+        }
+
+    def get_catalog(self):
+        version = get_templates_version()
+        catalog = self.catalog
+
+        if self.is_fresh(catalog, version):
+            return catalog
+
+        with self.lock:
+            catalog = self.catalog
+            if not self.is_fresh(catalog, version):
+                catalog = self.build(version)
+                self.catalog = catalog
+
+        return catalog
+
+    def response(self, request):
+        catalog = self.get_catalog()
+        response = current_app.response_class(mimetype='application/json')
+        response.set_etag(catalog['etag'], weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept-Encoding')
+
+        if request.if_none_match.contains_weak(catalog['etag']):
+            response.status_code = 304
+            return response
+
+        if request.accept_encodings['gzip'] > 0:
+            response.set_data(catalog['gzipped'])
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response.set_data(catalog['body'])
+
+        return response
+
+    def get_doctor_id(self, contract):
+        try:
+            return self.get_patient_info(contract.id).get('doctor_id')
+        except Exception as e:
+            log(e)
+            return None
+
+    def is_visible(self, template, contract, doctor_id):
+        # same order as the dashboard used to check on the client
+        if getattr(template, 'clinic_id', None):
+            return template.clinic_id == contract.clinic_id
+        if getattr(template, 'doctor_id', None):
+            return template.doctor_id == doctor_id
+        if getattr(template, 'clinics', None) not in [None, '']:
+            return str(contract.clinic_id) in clinic_ids(template.clinics)
+        if getattr(template, 'exclude_clinics', None) not in [None, '']:
+            return str(contract.clinic_id) not in clinic_ids(template.exclude_clinics)
+
+        return True
+
+    def supports_category(self, kind):
+        return hasattr(MODELS[kind], 'template_category')
+
+    def get_query(self, kind, contract, doctor_id, category=None, search=None):
+        model = MODELS[kind]
+        query = model.query.filter(model.is_template == True)
+
+        if category:
+            query = query.filter(model.template_category == category)
+
+        if search:
+            pattern = '%{}%'.format(search)
+            columns = SEARCH_COLUMNS.get(kind, ['title', 'template_category'])
+            query = query.filter(or_(*[getattr(model, column).ilike(pattern) for column in columns]))
+
+        # clinics and exclude_clinics are free-form json, they are checked in is_visible
+        if not contract.is_admin and hasattr(model, 'clinic_id'):
+            query = query.filter(or_(model.clinic_id == None, model.clinic_id == contract.clinic_id))
+            query = query.filter(or_(model.clinic_id != None, model.doctor_id == None,
+                                     model.doctor_id == doctor_id))
+
+        return query
+
+    def get_summaries(self, kind, contract, category=None, search=None, cursor=None, limit=50):
+        model = MODELS[kind]
+        limit = max(1, min(limit, 200))
+        doctor_id = None
+
+        # the doctor always comes from the contract, admins see every template anyway
+        if not contract.is_admin and hasattr(model, 'doctor_id'):
+            doctor_id = self.get_doctor_id(contract)
+
+        if doctor_id is not None:
+            doctor_id = int(doctor_id)
+
+        query = self.get_query(kind, contract, doctor_id, category, search).order_by(model.id)
+        items = []
+        last_id = cursor or 0
+
+        while True:
+            batch = query.filter(model.id > last_id).limit(limit).all()
+
+            for template in batch:
+                last_id = template.id
+
+                if contract.is_admin or self.is_visible(template, contract, doctor_id):
+                    items.append(template.as_summary())
+
+                    if len(items) == limit:
+                        return {"items": items, "next_cursor": last_id}
+
+            if len(batch) < limit:
+                return {"items": items, "next_cursor": None}
+
+    def get_template(self, kind, template_id):
+        return MODELS[kind].query.filter_by(id=template_id, is_template=True).first_or_404()
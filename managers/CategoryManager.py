@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+
+from helpers import log, get_redis
+from managers.Manager import Manager
+
+CATEGORIES_KEY = 'forms:categories'
+REFRESH_LOCK_KEY = 'forms:categories:refresh'
+CATEGORIES_TTL = 3600
+REFRESH_INTERVAL = 600
+RETRY_INTERVAL = 60
+
+
+class CategoryManager(Manager):
+    # shared by every instance in the process, the catalog is the same for all contracts
+    cache = {"categories": None, "names": {}, "json": '[]', "loaded": 0, "failed": 0}
+    lock = threading.Lock()
+    refresher_pid = None
+
+    def __init__(self, *args):
+        super(CategoryManager, self).__init__(*args)
+
+    def fetch(self, upstream=False):
+        if not upstream:
+            try:
+                cached = get_redis().get(CATEGORIES_KEY)
+                if cached:
+                    return json.loads(cached)
+            except Exception as e:
+                log(e)
+
+        categories = self.medsenger_api.get_categories()
+
+        if not isinstance(categories, list):
+            return None
+
+        try:
+            get_redis().set(CATEGORIES_KEY, json.dumps(categories), ex=CATEGORIES_TTL)
+        except Exception as e:
+            log(e)
+
+        return categories
+
+    def is_refresh_owner(self):
+        # one process per interval goes upstream, the others pick its result up from redis
+        try:
+            return bool(get_redis().set(REFRESH_LOCK_KEY, os.getpid(), nx=True, ex=REFRESH_INTERVAL))
+        except Exception as e:
+            log(e)
+            return True
+
+    def refresh(self, upstream=False):
+        try:
+            categories = self.fetch(upstream)
+        except Exception as e:
+            log(e)
+            categories = None
+
+        # the last good catalog stays in place and upstream is not asked again until the retry interval passes
+        if categories is None:
+            CategoryManager.cache = dict(CategoryManager.cache, failed=time.time())
+            return
+
+        CategoryManager.cache = {
+            "categories": categories,
+            "names": {category['name']: category['description'] for category in categories},
+            "json": json.dumps(categories),
+            "loaded": time.time(),
+            "failed": 0
+        }
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            self.refresh(upstream=self.is_refresh_owner())
+
+    def start_refresher(self):
+        # uwsgi and celery fork after import, so every process starts its own thread
+        if CategoryManager.refresher_pid == os.getpid():
+            return
+
+        CategoryManager.refresher_pid = os.getpid()
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+    def is_stale(self):
+        now = time.time()
+        cache = CategoryManager.cache
+
+        return now - cache['loaded'] > CATEGORIES_TTL and now - cache['failed'] > RETRY_INTERVAL
+
+    def get_cache(self):
+        if self.is_stale():
+            with CategoryManager.lock:
+                if self.is_stale():
+                    self.refresh()
+                self.start_refresher()
+
+        return CategoryManager.cache
+
+    def get_categories(self):
+        return self.get_cache()['categories'] or []
+
+    def get_names(self):
+        return self.get_cache()['names']
+
+    def get_json(self):
+        return self.get_cache()['json']
@@ -0,0 +1,48 @@
+from sqlalchemy import func, insert, select, union_all
+
+from managers.Manager import Manager
+from models import ActionRequest, ActionRequestArchive, ComplianceRollup
+
+
+class ComplianceManager(Manager):
+    def __init__(self, *args):
+        super(ComplianceManager, self).__init__(*args)
+
+    def rebuild(self, start=None, end=None, sources=None, commit=True):
+        # sources must hold every request of the [start, end) range, the rollup rows there are replaced
+        if sources is None:
+            sources = [ActionRequest.__table__, ActionRequestArchive.__table__]
+
+        query = ComplianceRollup.query
+        if start:
+            query = query.filter(ComplianceRollup.day >= start)
+        if end:
+            query = query.filter(ComplianceRollup.day < end)
+        query.delete()
+
+        selects = []
+        for source in sources:
+            request = select(source.c.contract_id, source.c.action, source.c.is_done, source.c.sent).where(
+                (source.c.contract_id != None) & (source.c.action != None) & (source.c.sent != None))
+
+            if start:
+                request = request.where(source.c.sent >= start)
+            if end:
+                request = request.where(source.c.sent < end)
+
+            selects.append(request)
+
+        requests = union_all(*selects).subquery()
+        day = func.date(requests.c.sent)
+
+        rows = select(requests.c.contract_id, requests.c.action, day,
+                      func.count(), func.count().filter(requests.c.is_done == True)) \
+            .group_by(requests.c.contract_id, requests.c.action, day)
+
+        self.db.session.execute(insert(ComplianceRollup).from_select(
+            ['contract_id', 'action', 'day', 'sent', 'done'], rows))
+
+        if commit:
+            self.__commit__()
+
+        return ComplianceRollup.query.count()
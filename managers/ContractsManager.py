@@ -10,7 +10,7 @@ class ContractManager(Manager):
 
     def add(self, contract_id, clinic_id):
         contract = Contract.query.filter_by(id=contract_id).first()
-        patient_info = self.medsenger_api.get_patient_info(contract_id)
+        patient_info = self.get_patient_info(contract_id)
         is_new = False
         if not contract:
             is_new = True
@@ -32,6 +32,9 @@ class ContractManager(Manager):
         contract.patient_timezone_offset = patient_info.get('timezone_offset')
         contract.clinic_id = clinic_id
 
+        if not is_new:
+            self.reschedule(contract)
+
         self.request_tokens(contract)
 
         self.__commit__()
@@ -84,16 +87,28 @@ class ContractManager(Manager):
     def get_active_ids(self):
         return [contract.id for contract in Contract.query.filter_by(is_active=True).all()]
 
-    def actualize_timezone(self, contract, commit=False):
-        info = self.medsenger_api.get_patient_info(contract.id)
+    def actualize_timezone(self, contract, commit=False, info=None):
+        if info is None:
+            info = self.get_patient_info(contract.id)
+
         contract.clinic_timezone = info.get('timezone')
         contract.patient_timezone_offset = info.get('timezone_offset')
 
+        self.reschedule(contract)
+
         if commit:
             self.__commit__()
 
+    def reschedule(self, contract):
+        for object in contract.medicines + contract.forms + contract.reminders:
+            object.next_fire_at = self.calculate_next_fire(object)
+
     def actualize_timezones(self):
-        for contract in Contract.query.filter_by(is_active=True).all():
-            self.actualize_timezone(contract)
+        contracts = Contract.query.filter_by(is_active=True).all()
+        infos = self.gather((self.get_patient_info, (contract.id,), {"fresh": True}) for contract in contracts)
+
+        for contract, info in zip(contracts, infos):
+            if info is not None:
+                self.actualize_timezone(contract, info=info)
 
         self.__commit__()
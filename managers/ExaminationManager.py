@@ -2,7 +2,7 @@ from datetime import datetime
 from datetime import timedelta
 
 from config import DYNAMIC_CACHE
-from helpers import log
+from helpers import log, bump_templates_version
 from managers.Manager import Manager
 from models import MedicalExamination
 
@@ -40,9 +40,9 @@ class ExaminationManager(Manager):
 
             new_examination.deadline_date = deadline_date
 
-            self.medsenger_api.send_message(contract.id,
-                                            "Врач назначил обследование {} (срок действия {} сут.). Его необходимо загрузить до {}."
-                                            .format(new_examination.title, new_examination.expiration_days,
+            self.outbox.send_message(contract.id,
+                                     "Врач назначил обследование {} (срок действия {} сут.). Его необходимо загрузить до {}."
+                                     .format(new_examination.title, new_examination.expiration_days,
                                                     new_examination.deadline_date.strftime('%d.%m.%Y')))
             self.db.session.add(new_examination)
             self.__commit__()
@@ -53,8 +53,9 @@ class ExaminationManager(Manager):
                 'object_type': 'examination',
                 'description': new_examination.doctor_description
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Назначено обследование "{}".'.format(new_examination.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Назначено обследование "{}".'.format(new_examination.title), params=params)
+            self.__commit__()
 
             return new_examination
         else:
@@ -74,7 +75,8 @@ class ExaminationManager(Manager):
         self.log_done("examination_{}".format(examination.id), contract_id)
 
         if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract_id)
+            self.outbox.update_cache(contract_id)
+            self.__commit__()
 
         return True
 
@@ -90,28 +92,31 @@ class ExaminationManager(Manager):
             return None
 
         if examination.contract_id:
-            self.medsenger_api.send_message(contract.id, "Врач отменил обследование {}.".format(examination.title))
+            self.outbox.send_message(contract.id, "Врач отменил обследование {}.".format(examination.title))
             params = {
                 'obj_id': examination.id,
                 'action': 'cancel',
                 'object_type': 'examination',
                 'description': examination.doctor_description
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Отменено обследование "{}".'.format(examination.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Отменено обследование "{}".'.format(examination.title), params=params)
 
         self.db.session.delete(examination)
         self.__commit__()
 
+        if examination.is_template:
+            bump_templates_version()
+
         return examination_id
 
-    def log_request(self, examination, contract_id=None, description=None):
+    def log_request(self, examination, contract_id=None, description=None, commit=True, buffer=None):
         if not contract_id:
             contract_id = examination.contract_id
         if not description:
             description = "Загрузка обследования {}".format(examination.title)
 
-        super().log_request("examination_{}".format(examination.id), contract_id, description)
+        super().log_request("examination_{}".format(examination.id), contract_id, description, commit, buffer)
 
     def run(self, examination):
         text = 'Пожалуйста, не забудьте загрузить обследование {}.'.format(examination.title)
@@ -119,9 +124,7 @@ class ExaminationManager(Manager):
         action_name = 'Загрузить обследование'
         deadline = self.calculate_deadline(examination)
 
-        result = self.medsenger_api.send_message(examination.contract_id, text, action, action_name, True, False, True,
-                                                 deadline)
-        return result
+        self.outbox.send_message(examination.contract_id, text, action, action_name, True, False, True, deadline)
 
     def create_or_edit(self, data, contract):
         try:
@@ -165,24 +168,27 @@ class ExaminationManager(Manager):
 
                 if is_new:
                     examination.attach_date = datetime.now()
-                    self.medsenger_api.send_message(contract.id,
-                                                    "Врач назначил обследование {} (срок действия {} сут.). Его необходимо загрузить до {}."
-                                                    .format(examination.title, examination.expiration_days,
+                    self.outbox.send_message(contract.id,
+                                             "Врач назначил обследование {} (срок действия {} сут.). Его необходимо загрузить до {}."
+                                             .format(examination.title, examination.expiration_days,
                                                             examination.deadline_date.strftime('%d.%m.%Y')))
                 else:
-                    self.medsenger_api.send_message(contract.id,
-                                                    "Врач изменил параметры обследования {} (срок действия {} сут.). Его необходимо загрузить до {}."
-                                                    .format(examination.title, examination.expiration_days,
+                    self.outbox.send_message(contract.id,
+                                             "Врач изменил параметры обследования {} (срок действия {} сут.). Его необходимо загрузить до {}."
+                                             .format(examination.title, examination.expiration_days,
                                                             examination.deadline_date.strftime('%d.%m.%Y')))
 
                 action = 'Назначено обследование' if is_new else 'Изменены параметры обследования'
-                self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                              '{} "{}".'.format(action, examination.title), params=params)
+                self.outbox.add_record(contract.id, 'doctor_action',
+                                       '{} "{}".'.format(action, examination.title), params=params)
 
             if not examination_id:
                 self.db.session.add(examination)
             self.__commit__()
 
+            if examination.is_template:
+                bump_templates_version()
+
             return examination
         except Exception as e:
             log(e)
@@ -4,7 +4,7 @@ from copy import copy
 from datetime import datetime
 
 from config import DYNAMIC_CACHE
-from helpers import log, clear_categories
+from helpers import log, clear_categories, bump_templates_version
 from managers.ContractsManager import ContractManager
 from managers.MedicineManager import MedicineManager
 from managers.Manager import Manager
@@ -37,7 +37,10 @@ class FormManager(Manager):
         Form.query.filter_by(id=id).delete()
 
         self.__commit__()
-        self.medsenger_api.update_cache(contract.id)
+
+        if form.is_template:
+            bump_templates_version()
+        self.outbox.update_cache(contract.id)
 
         if not form.is_template:
             params = {
@@ -46,8 +49,10 @@ class FormManager(Manager):
                 'object_type': 'form',
                 'description': form.doctor_description
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Отменен опросник "{}".'.format(form.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Отменен опросник "{}".'.format(form.title), params=params)
+
+        self.__commit__()
 
         return id
 
@@ -86,8 +91,9 @@ class FormManager(Manager):
                     log(e, False)
 
             if new_form.init_text:
-                self.medsenger_api.send_message(form.contract_id, form.init_text, only_patient=True)
+                self.outbox.send_message(form.contract_id, form.init_text, only_patient=True)
 
+            new_form.next_fire_at = self.calculate_next_fire(new_form)
             self.db.session.add(new_form)
             self.__commit__()
 
@@ -102,20 +108,21 @@ class FormManager(Manager):
                 'description': form.doctor_description,
                 'template_id': template_id
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Назначен опросник "{}".'.format(form.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Назначен опросник "{}".'.format(form.title), params=params)
+            self.__commit__()
 
             return new_form
         else:
             return False
 
-    def log_request(self, form, contract_id=None, description=None):
+    def log_request(self, form, contract_id=None, description=None, commit=True, buffer=None):
         if not contract_id:
             contract_id = form.contract_id
         if not description:
             description = "Заполнение опросника {}".format(form.title)
 
-        super().log_request("form_{}".format(form.id), contract_id, description)
+        super().log_request("form_{}".format(form.id), contract_id, description, commit, buffer)
 
     def run(self, form, commit=True, contract_id=None):
         text = 'Пожалуйста, заполните опросник "{}".'.format(form.title)
@@ -135,31 +142,37 @@ class FormManager(Manager):
         else:
             deadline = None
 
-        result = self.medsenger_api.send_message(contract_id, text, action, action_name, True, False, True, deadline)
+        self.outbox.send_message(contract_id, text, action, action_name, True, False, True, deadline)
         # telepat speaker
-        self.medsenger_api.send_order(contract_id, "form", 26, form.as_dict())
-
-        if result:
-            form.last_sent = datetime.now()
+        self.outbox.send_order(contract_id, "form", 26, form.as_dict())
 
-            if not form.asked_timestamp:
-                form.asked_timestamp = time.time()
+        form.last_sent = datetime.now()
+        form.next_fire_at = self.calculate_next_fire(form)
 
-            if commit:
-                self.__commit__()
+        if not form.asked_timestamp:
+            form.asked_timestamp = time.time()
 
-        return result
+        if commit:
+            self.__commit__()
 
-    def check_warning(self, form):
+    def get_warning(self, form):
         if form.warning_days and form.warning_timestamp == 0 and form.asked_timestamp:
             if time.time() - form.asked_timestamp > 24 * 60 * 60 * form.warning_days:
                 form.warning_timestamp = int(time.time())
 
-                self.medsenger_api.send_message(form.contract_id,
-                                                "Пациент не заполнял опросник {} уже {} дней.".format(form.title,
-                                                                                                      form.warning_days),
-                                                only_doctor=True, need_answer=False)
-                self.__commit__()
+                return form.contract_id, "Пациент не заполнял опросник {} уже {} дней.".format(form.title,
+                                                                                              form.warning_days), \
+                    {"only_doctor": True, "need_answer": False}
+
+        return None
+
+    def check_warning(self, form):
+        warning = self.get_warning(form)
+
+        if warning:
+            contract_id, text, params = warning
+            self.outbox.send_message(contract_id, text, **params)
+            self.__commit__()
 
     def __integral_result_report__(self, contract_id, form, integral_result):
         urgent = integral_result['params'].get('urgent', False)
@@ -179,17 +192,17 @@ class FormManager(Manager):
                     text += '<li>{} - {}</li>'.format(group, integral_result['params']['group_scores'][group])
                 text += '</ul>'
 
-            self.medsenger_api.send_message(contract_id, text, only_doctor=True, is_urgent=urgent)
+            self.outbox.send_message(contract_id, text, only_doctor=True, is_urgent=urgent)
 
         if integral_result['params'].get('message', None):
-            self.medsenger_api.send_message(contract_id, integral_result['params'].get('message'), only_patient=True,
-                                            is_urgent=urgent)
+            self.outbox.send_message(contract_id, integral_result['params'].get('message'), only_patient=True,
+                                     is_urgent=urgent)
         elif urgent and form.integral_evaluation.get('warning_text'):
-            self.medsenger_api.send_message(contract_id, form.integral_evaluation.get('warning_text'),
-                                            only_patient=True, is_urgent=urgent)
+            self.outbox.send_message(contract_id, form.integral_evaluation.get('warning_text'),
+                                     only_patient=True, is_urgent=urgent)
         elif not urgent and form.integral_evaluation.get('ok_text'):
-            self.medsenger_api.send_message(contract_id, form.integral_evaluation.get('ok_text'), only_patient=True,
-                                            is_urgent=urgent)
+            self.outbox.send_message(contract_id, form.integral_evaluation.get('ok_text'), only_patient=True,
+                                     is_urgent=urgent)
 
     def __instant_report__(self, contract_id, form, report):
         text = 'Пациент заполнил опросник "{}" и дал следующие ответы.<br><br>'.format(form.title)
@@ -198,11 +211,11 @@ class FormManager(Manager):
 
         deadline = time.time() + 1 * 60 * 60
 
-        self.medsenger_api.send_message(contract_id, text, only_doctor=True)
+        self.outbox.send_message(contract_id, text, only_doctor=True)
 
         if not form.thanks_text:
-            self.medsenger_api.send_message(contract_id,
-                                            'Спасибо за заполнение опросника "{}". Ответы отправлены вашему лечащему врачу.'.format(
+            self.outbox.send_message(contract_id,
+                                     'Спасибо за заполнение опросника "{}". Ответы отправлены вашему лечащему врачу.'.format(
                                                 form.title), only_patient=True, action_deadline=deadline)
 
     def _extract_packet_and_report_from_form(self, contract_id, form, answers):
@@ -222,8 +235,8 @@ class FormManager(Manager):
                     packet.append({"category_name": category, "value": comment, "files": [answers[field['uid']]]})
 
                     if field.get('params', {}).get('send_to_doctor'):
-                        self.medsenger_api.send_message(contract_id, '', send_from='patient', need_answer=False,
-                                                        attachments=[answers[field['uid']]])
+                        self.outbox.send_message(contract_id, '', send_from='patient', need_answer=False,
+                                                 attachments=[answers[field['uid']]])
                 elif field['type'] == 'radio':
                     category = field['params']['variants'][answers[field['uid']]]['category']
                     answer = field['params']['variants'][answers[field['uid']]].get('text')
@@ -396,7 +409,9 @@ class FormManager(Manager):
             self.log_done("form_{}".format(form.id), contract_id)
 
         if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract_id)
+            self.outbox.update_cache(contract_id)
+
+        self.__commit__()
 
         return True
 
@@ -542,21 +557,26 @@ class FormManager(Manager):
                 else:
                     form.algorithm_id = None
 
+            form.next_fire_at = self.calculate_next_fire(form)
+
             if not form_id:
                 self.db.session.add(form)
             self.__commit__()
 
+            if form.is_template:
+                bump_templates_version()
+
             if not form_id and form.contract_id:
                 self.db.session.refresh(form)
 
                 if form.init_text:
-                    self.medsenger_api.send_message(form.contract_id, form.init_text, only_patient=True)
+                    self.outbox.send_message(form.contract_id, form.init_text, only_patient=True)
 
                 if form.timetable.get('send_on_init'):
                     self.run(form)
 
             if DYNAMIC_CACHE:
-                self.medsenger_api.update_cache(contract.id)
+                self.outbox.update_cache(contract.id)
 
             if not form_id and not data.get('is_template'):
                 params = {
@@ -565,8 +585,10 @@ class FormManager(Manager):
                     'object_type': 'form',
                     'description': form.doctor_description
                 }
-                self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                              'Назначен опросник "{}".'.format(form.title), params=params)
+                self.outbox.add_record(contract.id, 'doctor_action',
+                                       'Назначен опросник "{}".'.format(form.title), params=params)
+
+            self.__commit__()
 
             return form
         except Exception as e:
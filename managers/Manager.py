@@ -2,66 +2,82 @@ import pytz
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 from medsenger_api import AgentApiClient
+from sqlalchemy import or_, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
 
-from helpers import timezone_now, localize
-from models import ActionRequest
+from helpers import log, timezone_now, localize, toUTC, next_timepoint, get_patient_info
+from async_api import AsyncApiClient
+from models import ActionRequest, Contract, Reminder, ComplianceRollup
+from outbox import OutboxClient
 
 
 class Manager:
     def __init__(self, medsenger_api: AgentApiClient, db: SQLAlchemy):
         self.medsenger_api = medsenger_api
         self.db = db
+        self.outbox = OutboxClient(medsenger_api, db)
+        self.async_api = AsyncApiClient(medsenger_api)
 
     def __commit__(self):
         self.db.session.commit()
 
-    def get_timepoints(self, timetable, zone=None):
-        now = timezone_now(zone)
-        raw = timetable['points']
-        points = []
-
-        if timetable['mode'] == 'daily':
-            points = list(
-                map(lambda p: localize(datetime(minute=int(p['minute']), hour=int(p['hour']), day=now.day, month=now.month,
-                                       year=now.year), zone), raw))
-            points.sort()
-            if points:
-                points.append(points[0] + timedelta(days=1))
-        if timetable['mode'] == 'weekly':
-            current_weekday_points = list(filter(lambda x: x['day'] == now.weekday(), raw))
-            current_weekday_points = list(
-                map(lambda p: localize(datetime(minute=int(p['minute']), hour=int(p['hour']), day=now.day, month=now.month,
-                                       year=now.year), zone), current_weekday_points))
-
-            next_points = []
-            for i in range(1, 8):
-                next_points = list(filter(lambda x: x['day'] == (now.weekday() + i) % 7, raw))
-
-                if next_points:
-                    break
-
-            next_points = list(
-                map(lambda p: localize(datetime(minute=int(p['minute']), hour=int(p['hour']), day=now.day, month=now.month,
-                                       year=now.year), zone) + timedelta(days=i), next_points))
-
-            points = current_weekday_points + next_points
-            points.sort()
-
-        if timetable['mode'] == 'monthly':
-            points = list(
-                map(lambda p: localize(datetime(minute=int(p['minute']), hour=int(p['hour']), day=int(p['day']), month=now.month,
-                                       year=now.year), zone), raw))
-            points.sort()
-            if points:
-                try:
-                    year = now.year if points[0].month + 1 <= 12 else now.year + 1
-                    month = 1 if points[0].month == 12 else points[0].month + 1
-                    points.append(
-                            localize(datetime(minute=points[0].minute, hour=points[0].hour, day=points[0].day, month=month,
-                                 year=year), zone))
-                except:
-                    pass
-        return points
+    def get_patient_info(self, contract_id, fresh=False):
+        return get_patient_info(self.medsenger_api, contract_id, fresh)
+
+    def gather(self, calls, limit=None):
+        return self.async_api.gather(calls, limit)
+
+    def iterate_active_contracts(self, *relationships, batch_size=500, where=None):
+        # yields batches and leaves the session alone, the caller commits and expunges a batch it is done with
+        options = [selectinload(getattr(Contract, relationship)) for relationship in relationships]
+        last_id = 0
+
+        while True:
+            query = Contract.query.filter((Contract.is_active == True) & (Contract.id > last_id))
+
+            if where is not None:
+                query = query.filter(where)
+
+            batch = query.order_by(Contract.id).options(*options).limit(batch_size).all()
+
+            if not batch:
+                break
+
+            last_id = batch[-1].id
+
+            yield batch
+
+    def get_local_zones(self, hour):
+        # (contract filter, local date) for every timezone currently at the given local hour
+        zones = self.db.session.query(Contract.clinic_timezone, Contract.patient_timezone_offset).distinct().all()
+        result = []
+
+        for clinic_timezone, offset in zones:
+            try:
+                if offset is not None:
+                    now = timezone_now(pytz.FixedOffset(-1 * offset))
+                    condition = Contract.patient_timezone_offset == offset
+                else:
+                    now = timezone_now(clinic_timezone)
+                    condition = (Contract.patient_timezone_offset == None) & (
+                            Contract.clinic_timezone == clinic_timezone)
+            except Exception as e:
+                log(e)
+                continue
+
+            if now.hour == hour:
+                result.append((condition, now.date()))
+
+        return result
+
+    def local_hour_filter(self, hour):
+        zones = self.get_local_zones(hour)
+
+        if not zones:
+            return None
+
+        return or_(*[condition for condition, day in zones])
 
     def calculate_deadline(self, obj):
         zone = None
@@ -69,29 +85,98 @@ class Manager:
         if obj.contract:
             zone = obj.contract.get_actual_timezone()
 
-        if obj.timetable.get('mode') == 'manual':
+        if not getattr(obj, 'timetable', None) or obj.timetable.get('mode') == 'manual':
             return None
 
-        now = timezone_now(zone)
-        points = self.get_timepoints(obj.timetable, zone)
+        greater = next_timepoint(obj.get_compiled_timetable(), timezone_now(zone), zone, horizon=32)
 
-        if points:
-            greater = next(filter(lambda x: x > now, points))
-        else:
+        if not greater:
             return None
 
         return int(greater.timestamp() - 1)
 
+    def calculate_next_fire(self, obj, since=None):
+        if obj.is_template or not obj.contract_id or not obj.timetable:
+            return None
+
+        if getattr(obj, 'canceled_at', None) is not None or getattr(obj, 'notifications_disabled', False):
+            return None
+
+        if obj.timetable.get('mode') == 'manual':
+            return None
+
+        contract = obj.contract or Contract.query.filter_by(id=obj.contract_id).first()
+        zone = contract.get_actual_timezone() if contract else None
+        now = timezone_now(zone)
+
+        if since is None:
+            since = now - timedelta(minutes=5)
+            if obj.last_sent:
+                since = max(localize(obj.last_sent), since)
+
+        if isinstance(obj, Reminder) and obj.send_next:
+            send_next = localize(obj.send_next, zone)
+            return toUTC(send_next).replace(tzinfo=None) if send_next > since else None
+
+        greater = next_timepoint(obj.get_compiled_timetable(), since.astimezone(now.tzinfo), zone)
+
+        if greater:
+            return toUTC(greater).replace(tzinfo=None)
+
+        return None
+
     def get_templates(self):
         return []
 
     def get_templates_as_dicts(self):
         return [template.as_dict() for template in self.get_templates()]
 
-    def log_request(self, action, contract_id=None, description=None):
+    def update_compliance(self, contract_id, action, day, sent=0, done=0):
+        self.update_compliance_rows([{"contract_id": contract_id, "action": action, "day": day,
+                                      "sent": sent, "done": done}])
+
+    def update_compliance_rows(self, rows):
+        rows = [row for row in rows if row['contract_id'] and row['action']]
+
+        if not rows:
+            return
+
+        dialect = postgresql if self.db.engine.dialect.name == 'postgresql' else sqlite
+        statement = dialect.insert(ComplianceRollup).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['contract_id', 'action', 'day'],
+            set_={'sent': ComplianceRollup.sent + statement.excluded.sent,
+                  'done': ComplianceRollup.done + statement.excluded.done})
+
+        self.db.session.execute(statement)
+
+    def log_request(self, action, contract_id=None, description=None, commit=True, buffer=None):
+        if buffer is not None:
+            buffer.append({"contract_id": contract_id, "action": action, "description": description})
+            return
+
         self.db.session.add(
             ActionRequest(contract_id=contract_id, action=action, description=description))
-        self.__commit__()
+        self.update_compliance(contract_id, action, datetime.now().date(), sent=1)
+
+        if commit:
+            self.__commit__()
+
+    def flush_requests(self, buffer):
+        if not buffer:
+            return
+
+        now = datetime.now()
+        counts = {}
+
+        for row in buffer:
+            key = (row['contract_id'], row['action'])
+            counts[key] = counts.get(key, 0) + 1
+
+        self.db.session.execute(insert(ActionRequest), [dict(row, sent=now) for row in buffer])
+        self.update_compliance_rows([{"contract_id": contract_id, "action": action, "day": now.date(),
+                                      "sent": sent, "done": 0} for (contract_id, action), sent in counts.items()])
+        buffer.clear()
 
     def log_done(self, action, contract_id):
         record = ActionRequest.query.filter_by(contract_id=contract_id, action=action).order_by(
@@ -100,5 +185,6 @@ class Manager:
         if record and not record.is_done:
             record.is_done = True
             record.done = datetime.now()
+            self.update_compliance(contract_id, action, (record.sent or record.done).date(), done=1)
             self.__commit__()
 
@@ -1,8 +1,10 @@
 import time
 from datetime import datetime
 
+from sqlalchemy import or_
+
 from config import DYNAMIC_CACHE
-from helpers import log
+from helpers import log, bump_templates_version
 from managers.Manager import Manager
 from models import Patient, Contract, Medicine
 
@@ -16,6 +18,7 @@ class MedicineManager(Manager):
 
         for medicine in medicines:
             medicine.canceled_at = datetime.now()
+            medicine.next_fire_at = None
 
         self.__commit__()
 
@@ -47,10 +50,11 @@ class MedicineManager(Manager):
                     ]
                 }
 
-            self.medsenger_api.send_message(contract.id, "Врач назначил препарат {}.{}"
-                                            .format(new_medicine.get_description(True),
+            self.outbox.send_message(contract.id, "Врач назначил препарат {}.{}"
+                                     .format(new_medicine.get_description(True),
                                                     " Мы будем автоматически присылать напоминания о приемах." if
                                                     new_medicine.timetable['mode'] != "manual" else ''))
+            new_medicine.next_fire_at = self.calculate_next_fire(new_medicine)
             self.db.session.add(new_medicine)
             self.__commit__()
 
@@ -60,8 +64,9 @@ class MedicineManager(Manager):
                 'object_type': 'medicine',
                 'description': new_medicine.get_description(True, False)
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Назначен препарат "{}".'.format(new_medicine.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Назначен препарат "{}".'.format(new_medicine.title), params=params)
+            self.__commit__()
 
             return medicine
         else:
@@ -78,7 +83,7 @@ class MedicineManager(Manager):
 
         return medicine
 
-    def check_warning(self, medicine):
+    def get_warning(self, medicine):
         if medicine.warning_days and medicine.warning_timestamp == 0 and medicine.asked_timestamp:
             time_from = medicine.asked_timestamp
             if medicine.prescribed_at:
@@ -86,10 +91,18 @@ class MedicineManager(Manager):
             if time.time() - time_from > 24 * 60 * 60 * medicine.warning_days:
                 medicine.warning_timestamp = int(time.time())
 
-                self.medsenger_api.send_message(medicine.contract_id,
-                                                "Пациент не сообщал о приеме лекарства {} уже {} дней.".format(
-                                                    medicine.title, medicine.warning_days), only_doctor=True)
-                self.__commit__()
+                return medicine.contract_id, "Пациент не сообщал о приеме лекарства {} уже {} дней.".format(
+                    medicine.title, medicine.warning_days), {"only_doctor": True}
+
+        return None
+
+    def check_warning(self, medicine):
+        warning = self.get_warning(medicine)
+
+        if warning:
+            contract_id, text, params = warning
+            self.outbox.send_message(contract_id, text, **params)
+            self.__commit__()
 
     def submit(self, medicine_id, contract_id, params=None):
         medicine = self.get(medicine_id)
@@ -109,7 +122,8 @@ class MedicineManager(Manager):
         self.log_done("medicine_{}".format(medicine_id), contract_id)
 
         if DYNAMIC_CACHE:
-            self.medsenger_api.update_cache(contract_id)
+            self.outbox.update_cache(contract_id)
+            self.__commit__()
 
         return True
 
@@ -126,17 +140,18 @@ class MedicineManager(Manager):
             return None
 
         if medicine.contract_id:
-            self.medsenger_api.send_message(contract.id, "Врач возобновил препарат {}.".format(medicine.get_description()))
+            self.outbox.send_message(contract.id, "Врач возобновил препарат {}.".format(medicine.get_description()))
             params = {
                 'obj_id': medicine.id,
                 'action': 'resume',
                 'object_type': 'medicine',
                 'description': medicine.get_description(True, False)
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action',
-                                          'Возобновлен препарат "{}".'.format(medicine.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action',
+                                   'Возобновлен препарат "{}".'.format(medicine.title), params=params)
 
         medicine.canceled_at = None
+        medicine.next_fire_at = self.calculate_next_fire(medicine)
 
         self.__commit__()
 
@@ -151,37 +166,47 @@ class MedicineManager(Manager):
 
         if medicine.contract_id:
             if not by_patient:
-                self.medsenger_api.send_message(contract.id, "Врач отменил препарат {}.".format(medicine.get_description()))
+                self.outbox.send_message(contract.id, "Врач отменил препарат {}.".format(medicine.get_description()))
             params = {
                 'obj_id': medicine.id,
                 'action': 'cancel',
                 'object_type': 'medicine',
                 'description': medicine.get_description(True, False)
             }
-            self.medsenger_api.add_record(contract.id, 'doctor_action' if not by_patient else 'action',
-                                          'Отменен препарат "{}".'.format(medicine.title), params=params)
+            self.outbox.add_record(contract.id, 'doctor_action' if not by_patient else 'action',
+                                   'Отменен препарат "{}".'.format(medicine.title), params=params)
 
         medicine.canceled_at = datetime.now()
+        medicine.next_fire_at = None
 
         self.__commit__()
 
+        if medicine.is_template:
+            bump_templates_version()
+
         return id
 
-    def check_detach_dates(self, app):
+    def check_detach_dates(self, app, hour=3):
         with app.app_context():
-            medicines = list(Medicine.query.filter(
-                (Medicine.detach_date == datetime.now().date()) & (Medicine.is_template == False) & (Medicine.canceled_at == None)).all())
+            zones = self.get_local_zones(hour)
+
+            if not zones:
+                return
+
+            medicines = list(Medicine.query.join(Contract, Contract.id == Medicine.contract_id).filter(
+                or_(*[condition & (Medicine.detach_date == day) for condition, day in zones]) &
+                (Medicine.is_template == False) & (Medicine.canceled_at == None)).all())
 
             for medicine in medicines:
-                self.medsenger_api.send_message(medicine.contract_id,"Врач отменил препарат {}.".format(medicine.get_description()))
+                self.outbox.send_message(medicine.contract_id,"Врач отменил препарат {}.".format(medicine.get_description()))
                 params = {
                     'obj_id': medicine.id,
                     'action': 'cancel',
                     'object_type': 'medicine',
                     'description': medicine.get_description(True, False)
                 }
-                self.medsenger_api.add_record(medicine.contract_id, 'doctor_action',
-                                              'Отменен препарат "{}".'.format(medicine.title), params=params)
+                self.outbox.add_record(medicine.contract_id, 'doctor_action',
+                                       'Отменен препарат "{}".'.format(medicine.title), params=params)
 
                 record = {
                     'description': 'Отменен',
@@ -197,15 +222,16 @@ class MedicineManager(Manager):
                 else:
                     medicine.prescription_history = {'records': [record]}
                 medicine.canceled_at = datetime.now()
+                medicine.next_fire_at = None
             self.__commit__()
 
-    def log_request(self, medicine, contract_id=None, description=None):
+    def log_request(self, medicine, contract_id=None, description=None, commit=True, buffer=None):
         if not contract_id:
             contract_id = medicine.contract_id
         if not description:
             description = "Подтверждение приема лекарства {}".format(medicine.title)
 
-        super().log_request("medicine_{}".format(medicine.id), contract_id, description)
+        super().log_request("medicine_{}".format(medicine.id), contract_id, description, commit, buffer)
 
     def run(self, medicine, commit=True):
         text = 'Пожалуйста, не забудьте принять лекарство {}.'.format(medicine.get_description())
@@ -213,21 +239,18 @@ class MedicineManager(Manager):
         action_name = 'Подтвердить прием'
         deadline = self.calculate_deadline(medicine)
 
-        result = self.medsenger_api.send_message(medicine.contract_id, text, action, action_name, True, False, True,
-                                                 deadline)
+        self.outbox.send_message(medicine.contract_id, text, action, action_name, True, False, True, deadline)
         # telepat speaker
-        self.medsenger_api.send_order(medicine.contract_id, "medicine", 26, medicine.as_dict())
+        self.outbox.send_order(medicine.contract_id, "medicine", 26, medicine.as_dict())
 
-        if result:
-            medicine.last_sent = datetime.now()
+        medicine.last_sent = datetime.now()
+        medicine.next_fire_at = self.calculate_next_fire(medicine)
 
-            if not medicine.asked_timestamp:
-                medicine.asked_timestamp = time.time()
+        if not medicine.asked_timestamp:
+            medicine.asked_timestamp = time.time()
 
-            if commit:
-                self.__commit__()
-
-        return result
+        if commit:
+            self.__commit__()
 
     def edit_history(self, data):
         try:
@@ -296,19 +319,24 @@ class MedicineManager(Manager):
                 }
 
                 if not data.get('edited_by_patient'):
-                    self.medsenger_api.send_message(contract.id,
-                                                    "Врач {} {}.{}".format(
+                    self.outbox.send_message(contract.id,
+                                             "Врач {} {}.{}".format(
                                                         action, medicine.get_description(True),
                                                         " Мы будем автоматически присылать напоминания о приемах." if
                                                         medicine.timetable['mode'] != "manual" else ''))
                 action = 'Назначен препарат' if is_new else 'Изменены параметры приема препарата'
-                self.medsenger_api.add_record(contract.id, 'doctor_action' if not data.get('edited_by_patient') else 'action',
-                                              '{} "{}".'.format(action, medicine.title), params=params)
+                self.outbox.add_record(contract.id, 'doctor_action' if not data.get('edited_by_patient') else 'action',
+                                       '{} "{}".'.format(action, medicine.title), params=params)
+
+            medicine.next_fire_at = self.calculate_next_fire(medicine)
 
             if not medicine_id:
                 self.db.session.add(medicine)
             self.__commit__()
 
+            if medicine.is_template:
+                bump_templates_version()
+
             return medicine
         except Exception as e:
             log(e)
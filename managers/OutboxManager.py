@@ -0,0 +1,210 @@
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from medsenger_api import prepare_binary
+from sqlalchemy import func, update
+
+from config import DISPATCH_WORKERS
+from helpers import log, gts
+from managers.Manager import Manager
+from models import Outbox
+
+BATCH_SIZE = 500
+CHAIN_SIZE = 100
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 15
+MAX_BACKOFF_SECONDS = 60 * 60
+KEEP_SENT_DAYS = 7
+LEASE_SECONDS = 5 * 60
+
+
+class OutboxManager(Manager):
+    def __init__(self, *args):
+        super(OutboxManager, self).__init__(*args)
+        self.executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS)
+
+    def get_chains(self):
+        # rows of a contract go out in order, so a row waiting for a retry holds back the ones after it;
+        # contracts are picked by their oldest pending row, so a backed off one does not take a place in the batch
+        now = datetime.now()
+        pending = (Outbox.sent_at == None) & (Outbox.failed_at == None)
+        is_due = ((Outbox.next_attempt_at == None) | (Outbox.next_attempt_at <= now)) & (
+                (Outbox.locked_until == None) | (Outbox.locked_until <= now))
+
+        heads = self.db.session.query(func.min(Outbox.id).label('id')).filter(pending) \
+            .group_by(Outbox.contract_id).subquery()
+        head_ids = [row_id for row_id, in self.db.session.query(Outbox.id).join(heads, Outbox.id == heads.c.id)
+                    .filter(is_due).order_by(Outbox.id).limit(BATCH_SIZE)]
+
+        if not head_ids:
+            return []
+
+        contracts = self.db.session.query(Outbox.contract_id).filter(Outbox.id.in_(head_ids))
+        position = func.row_number().over(partition_by=Outbox.contract_id, order_by=Outbox.id).label('position')
+        rows = self.db.session.query(Outbox.id, Outbox.contract_id, Outbox.next_attempt_at, Outbox.locked_until,
+                                     position) \
+            .filter(pending & (Outbox.contract_id.in_(contracts) | Outbox.id.in_(head_ids))).subquery()
+
+        chains = {}
+        blocked = set()
+
+        for row_id, contract_id, next_attempt_at, locked_until in self.db.session.query(
+                rows.c.id, rows.c.contract_id, rows.c.next_attempt_at, rows.c.locked_until) \
+                .filter(rows.c.position <= CHAIN_SIZE).order_by(rows.c.id):
+            if contract_id in blocked:
+                continue
+
+            # another sender is still working on this contract
+            if locked_until and locked_until > now:
+                blocked.add(contract_id)
+                chains.pop(contract_id, None)
+                continue
+
+            # the head is due by construction, a later row may still be backed off
+            if contract_id in chains and next_attempt_at and next_attempt_at > now:
+                blocked.add(contract_id)
+                continue
+
+            chains.setdefault(contract_id, []).append(row_id)
+
+        return list(chains.values())
+
+    def set_lease(self, ids, token, claimed_by=None):
+        # the update is atomic, so of two senders reading the same rows only one gets each of them back
+        pending = (Outbox.sent_at == None) & (Outbox.failed_at == None)
+        owner = (Outbox.locked_until == None) | (Outbox.locked_until <= datetime.now()) \
+            if claimed_by is None else Outbox.claimed_by == claimed_by
+
+        statement = update(Outbox).where(Outbox.id.in_(ids) & pending & owner).values(
+            claimed_by=token, locked_until=datetime.now() + timedelta(seconds=LEASE_SECONDS) if token else None) \
+            .returning(Outbox.id).execution_options(synchronize_session=False)
+
+        leased = {row_id for row_id, in self.db.session.execute(statement)}
+        self.__commit__()
+
+        return leased
+
+    def claim(self, chains):
+        token = uuid.uuid4().hex
+        claimed = self.set_lease([row_id for ids in chains for row_id in ids], token)
+        result = []
+
+        for ids in chains:
+            if all(row_id in claimed for row_id in ids):
+                result.append(ids)
+            elif any(row_id in claimed for row_id in ids):
+                # a chain split with another sender would break the order, both give up their part
+                self.set_lease(ids, None, token)
+
+        return token, result
+
+    def send_chain(self, app, token, ids):
+        with app.app_context():
+            for index, row_id in enumerate(ids):
+                # renewing the lease also checks it was not lost while the previous rows were sent
+                if not self.set_lease([row_id], token, token):
+                    break
+
+                row = Outbox.query.filter_by(id=row_id).first()
+
+                if not self.send(row):
+                    self.set_lease(ids[index + 1:], None, token)
+                    break
+
+    def send_file_by_link(self, contract_id, link, text):
+        answer = requests.get(link, timeout=30)
+        answer.raise_for_status()
+
+        if "Content-Disposition" in answer.headers.keys():
+            fname = re.findall("filename=(.+)", answer.headers["Content-Disposition"])[0]
+        else:
+            fname = link.split("/")[-1]
+
+        return self.medsenger_api.send_message(contract_id, text, only_patient=True,
+                                               attachments=[prepare_binary(fname, answer.content)])
+
+    def send(self, row):
+        try:
+            method = self.send_file_by_link if row.method == 'send_file_by_link' else getattr(self.medsenger_api,
+                                                                                               row.method)
+            result = method(*(row.args or []), **(row.kwargs or {}))
+            error = None if result is not None else 'empty response'
+        except Exception as e:
+            log(e)
+            error = str(e)
+
+        row.attempts += 1
+        row.claimed_by = None
+        row.locked_until = None
+
+        if error is None:
+            row.sent_at = datetime.now()
+        elif row.attempts >= MAX_ATTEMPTS:
+            row.failed_at = datetime.now()
+            row.last_error = error
+            print(gts(), "outbox {} {} for contract {} failed after {} attempts: {}".format(
+                row.id, row.method, row.contract_id, row.attempts, error), "CRITICAL")
+        else:
+            row.next_attempt_at = datetime.now() + timedelta(
+                seconds=min(BACKOFF_SECONDS * 2 ** (row.attempts - 1), MAX_BACKOFF_SECONDS))
+            row.last_error = error
+
+        self.__commit__()
+
+        # a failed row no longer blocks its contract
+        return error is None or row.failed_at is not None
+
+    def get_stats(self):
+        pending = (Outbox.sent_at == None) & (Outbox.failed_at == None)
+        oldest = self.db.session.query(func.min(Outbox.created_at)).filter(pending).scalar()
+
+        return {
+            "pending": Outbox.query.filter(pending).count(),
+            "retrying": Outbox.query.filter(pending & (Outbox.attempts > 0)).count(),
+            "failed": Outbox.query.filter(Outbox.failed_at != None).count(),
+            "failed_last_day": Outbox.query.filter(Outbox.failed_at > datetime.now() - timedelta(days=1)).count(),
+            "oldest_pending_seconds": int((datetime.now() - oldest).total_seconds()) if oldest else 0
+        }
+
+    def drain(self, app):
+        with app.app_context():
+            token, chains = self.claim(self.get_chains())
+            self.db.session.remove()
+
+        futures = [self.executor.submit(self.send_chain, app, token, ids) for ids in chains]
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                log(e, True)
+
+        return sum(len(ids) for ids in chains)
+
+    def cleanup(self, app):
+        with app.app_context():
+            try:
+                Outbox.query.filter(Outbox.sent_at < datetime.now() - timedelta(days=KEEP_SENT_DAYS)).delete()
+                self.__commit__()
+            except Exception as e:
+                self.db.session.rollback()
+                log(e)
+
+    def run(self, app, idle=1):
+        cleaned = 0
+
+        while True:
+            try:
+                if not self.drain(app):
+                    time.sleep(idle)
+            except Exception as e:
+                log(e, True)
+                time.sleep(idle)
+
+            if time.time() - cleaned > 60 * 60:
+                self.cleanup(app)
+                cleaned = time.time()
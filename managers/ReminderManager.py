@@ -1,7 +1,7 @@
 import time
 from datetime import datetime, timedelta
 
-from helpers import log, timezone_now
+from helpers import log, timezone_now, bump_templates_version
 from managers.Manager import Manager
 from models import Patient, Contract, Reminder
 
@@ -29,6 +29,7 @@ class ReminderManager(Manager):
             new_reminder.contract_id = contract.id
             new_reminder.patient_id = contract.patient.id
             new_reminder.attach_date = datetime.now()
+            new_reminder.next_fire_at = self.calculate_next_fire(new_reminder)
 
             self.db.session.add(new_reminder)
             self.__commit__()
@@ -49,8 +50,13 @@ class ReminderManager(Manager):
             return None
 
         reminder.canceled_at = datetime.now()
+        reminder.next_fire_at = None
 
         self.__commit__()
+
+        if reminder.is_template:
+            bump_templates_version()
+
         return id
 
     def set_state(self, reminder, state):
@@ -77,20 +83,23 @@ class ReminderManager(Manager):
         deadline = (timezone_now(reminder.contract.get_actual_timezone()) + timedelta(days=1)).timestamp()
 
         if state == 'later':
-            result = self.medsenger_api.send_message(reminder.contract_id, 'Напоминание автоматически отправится позже.',
-                                                     only_patient=reminder.type == 'patient', only_doctor=reminder.type == 'doctor',
-                                                     action_deadline=deadline)
-            return result
+            self.outbox.send_message(reminder.contract_id, 'Напоминание автоматически отправится позже.',
+                                     only_patient=reminder.type == 'patient', only_doctor=reminder.type == 'doctor',
+                                     action_deadline=deadline)
+            self.__commit__()
+            return reminder.id
 
         reminder.canceled_at = datetime.now()
-        self.__commit__()
+        reminder.next_fire_at = None
 
         if patient_text:
-            result = self.medsenger_api.send_message(reminder.contract_id, patient_text, only_patient=True, action_deadline=deadline)
+            self.outbox.send_message(reminder.contract_id, patient_text, only_patient=True, action_deadline=deadline)
         if doctor_text:
-            result = self.medsenger_api.send_message(reminder.contract_id, doctor_text, only_doctor=True, action_deadline=deadline)
+            self.outbox.send_message(reminder.contract_id, doctor_text, only_doctor=True, action_deadline=deadline)
 
-        return result
+        self.__commit__()
+
+        return reminder.id
 
     def set_next_date(self, id, contract, type, count):
         reminder = Reminder.query.filter_by(id=id).first_or_404()
@@ -99,14 +108,17 @@ class ReminderManager(Manager):
             return None
 
         send_next = None
+        # stored as naive local time of the contract, like every other timestamp of the timetable
+        now = timezone_now(contract.get_actual_timezone()).replace(tzinfo=None)
 
         if type == 'hour':
-            send_next = timezone_now(contract.get_actual_timezone()) + timedelta(hours=count)
+            send_next = now + timedelta(hours=count)
         elif type == 'day':
-            send_next = timezone_now(contract.get_actual_timezone()) + timedelta(days=count)
+            send_next = now + timedelta(days=count)
 
         reminder.send_next = send_next
         reminder.state = 'later'
+        reminder.next_fire_at = self.calculate_next_fire(reminder)
 
         self.__commit__()
         return reminder.id
@@ -145,16 +157,21 @@ class ReminderManager(Manager):
                 reminder.patient_id = contract.patient_id
                 reminder.contract_id = contract.id
 
+            reminder.next_fire_at = self.calculate_next_fire(reminder)
+
             if not reminder_id:
                 self.db.session.add(reminder)
             self.__commit__()
 
+            if reminder.is_template:
+                bump_templates_version()
+
             return reminder
         except Exception as e:
             log(e)
             return None
 
-    def log_request(self, reminder, contract_id=None, description=None):
+    def log_request(self, reminder, contract_id=None, description=None, commit=True, buffer=None):
         if not contract_id:
             contract_id = reminder.contract_id
         if not description:
@@ -164,10 +181,10 @@ class ReminderManager(Manager):
             if reminder.type == 'patient' or reminder.type == 'both':
                 description += "Отправка напоминания врачу: \"{}\".".format(reminder.text)
 
-        super().log_request("reminder_{}".format(reminder.id), contract_id, description)
+        super().log_request("reminder_{}".format(reminder.id), contract_id, description, commit, buffer)
 
     def run(self, reminder, commit=True):
-        result = None
+        queued = False
         action_name = None
         action_link = None
 
@@ -178,22 +195,25 @@ class ReminderManager(Manager):
                 action_link = 'reminder/{}'.format(reminder.id)
 
             if reminder.type == 'patient':
-                result = self.medsenger_api.send_message(reminder.contract_id, reminder.text, action_name=action_name,
-                                                         action_onetime=True, action_big=False,
-                                                         action_link=action_link, only_patient=True)
+                self.outbox.send_message(reminder.contract_id, reminder.text, action_name=action_name,
+                                         action_onetime=True, action_big=False,
+                                         action_link=action_link, only_patient=True)
+                queued = True
             if reminder.type == 'doctor':
-                result = self.medsenger_api.send_message(reminder.contract_id, reminder.text, action_name=action_name,
-                                                         action_onetime=True, action_big=False,
-                                                         action_link=action_link, only_doctor=True)
+                self.outbox.send_message(reminder.contract_id, reminder.text, action_name=action_name,
+                                         action_onetime=True, action_big=False,
+                                         action_link=action_link, only_doctor=True)
+                queued = True
         if reminder.has_order:
             params = reminder.order_params if reminder.order_params else None
             agent_id = reminder.order_agent_id if reminder.order_agent_id else None
-            result = self.medsenger_api.send_order(reminder.contract_id, reminder.order, receiver_id=reminder.order_agent_id, params=reminder.order_params)
+            self.outbox.send_order(reminder.contract_id, reminder.order, receiver_id=reminder.order_agent_id, params=reminder.order_params)
+            queued = True
 
-        if result:
+        if queued:
             reminder.last_sent = datetime.now()
+            reminder.next_fire_at = self.calculate_next_fire(reminder)
             if commit:
                 self.__commit__()
-                return result
 
-        return result
+        return queued
@@ -0,0 +1,120 @@
+import threading
+
+from sqlalchemy import text
+
+from helpers import log
+from managers.Manager import Manager
+
+
+class ShardManager(Manager):
+    LOCK_NAMESPACE = 7301
+    LEADER_KEY = -1
+
+    def __init__(self, shards, *args):
+        super(ShardManager, self).__init__(*args)
+        self.shards = shards
+        self.connection = None
+        self.home_shard = None
+        self.is_leader = False
+        self.lock = threading.Lock()
+
+    def __try_lock(self, key):
+        return bool(self.connection.execute(text("SELECT pg_try_advisory_lock(:namespace, :key)"),
+                                            {"namespace": self.LOCK_NAMESPACE, "key": key}).scalar())
+
+    def __unlock(self, key):
+        self.connection.execute(text("SELECT pg_advisory_unlock(:namespace, :key)"),
+                                {"namespace": self.LOCK_NAMESPACE, "key": key})
+
+    def __reset(self):
+        try:
+            # closing would hand the connection back to the pool with its locks still held,
+            # invalidating drops the session so the shards are free for other replicas
+            if self.connection is not None:
+                self.connection.invalidate()
+                self.connection.close()
+        except Exception as e:
+            log(e, False)
+
+        self.connection = None
+        self.home_shard = None
+        self.is_leader = False
+
+    def claim(self, app):
+        # advisory locks live as long as the connection, so a dead replica releases its shard automatically
+        with self.lock, app.app_context():
+            try:
+                if self.connection is None:
+                    self.connection = self.db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+                else:
+                    self.connection.execute(text("SELECT 1"))
+
+                if self.home_shard is None:
+                    self.home_shard = next(filter(self.__try_lock, range(self.shards)), None)
+
+                if not self.is_leader:
+                    self.is_leader = self.__try_lock(self.LEADER_KEY)
+            except Exception as e:
+                log(e, True)
+                self.__reset()
+
+            return self.home_shard, self.is_leader
+
+    def adopt(self, shard):
+        with self.lock:
+            try:
+                return self.connection is not None and self.__try_lock(shard)
+            except Exception as e:
+                log(e, True)
+                return False
+
+    def release(self, shard):
+        with self.lock:
+            try:
+                self.__unlock(shard)
+            except Exception as e:
+                log(e, True)
+
+    def run_shard(self, job, app, shard):
+        # one failing shard must not keep the others from running
+        try:
+            job(app, shard, self.shards)
+        except Exception as e:
+            log(e, True)
+
+    def run_sharded(self, job, app):
+        home_shard, is_leader = self.claim(app)
+
+        if home_shard is not None:
+            self.run_shard(job, app, home_shard)
+
+        if not is_leader:
+            return
+
+        # shards without a live replica are processed by the leader until someone claims them again
+        for shard in range(self.shards):
+            if shard == home_shard or not self.adopt(shard):
+                continue
+
+            try:
+                self.run_shard(job, app, shard)
+            finally:
+                self.release(shard)
+
+    def run_leading(self, job, app):
+        home_shard, is_leader = self.claim(app)
+
+        if is_leader:
+            job(app)
+
+    def sharded(self, job):
+        if self.shards <= 1:
+            return job
+
+        return lambda app: self.run_sharded(job, app)
+
+    def leading(self, job):
+        if self.shards <= 1:
+            return job
+
+        return lambda app: self.run_leading(job, app)
@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
 from datetime import datetime, timedelta
 import time
-from helpers import log, timezone_now, localize
-from managers.FormManager import FormManager
+
+from sqlalchemy import update
+
+from config import DISPATCH_WORKERS, ALGORITHM_CHUNK_SIZE
+from helpers import log, timezone_now, localize, get_day_minutes
 from managers.Manager import Manager
-from managers.MedicineManager import MedicineManager
-from models import Contract, Medicine, Reminder
+from models import Contract, Medicine, Reminder, Form, Algorithm
 from threading import Thread
 
 
@@ -14,6 +18,7 @@ class TimetableManager(Manager):
         self.medicine_manager = medicine_manager
         self.form_manager = form_manager
         self.reminder_manager = reminder_manager
+        self.executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS)
 
     def should_run(self, object, today=False):
         zone = object.contract.get_actual_timezone()
@@ -38,137 +43,244 @@ class TimetableManager(Manager):
         if isinstance(object, Reminder) and object.send_next:
             return now >= localize(object.send_next, zone) > last_sent
 
-        points = timetable['points']
-        if timetable['mode'] == 'weekly':
-            points = list(filter(lambda x: x['day'] == now.weekday(), points))
-        if timetable['mode'] == 'monthly':
-            points = list(filter(lambda x: x['day'] == now.day, points))
+        minutes = get_day_minutes(object.get_compiled_timetable(), now.date())
 
         if today:
-            return bool(points)
+            return bool(minutes)
+
+        last_sent = last_sent.astimezone(now.tzinfo)
+
+        if last_sent.date() > now.date():
+            return False
 
-        timepoints = list(
-            map(lambda p:
-                localize(
-                    datetime(minute=int(p['minute']), hour=int(p['hour']), day=now.day, month=now.month, year=now.year),
-                    zone
-                ),
-                points)
-        )
+        lower = last_sent.hour * 60 + last_sent.minute if last_sent.date() == now.date() else -1
 
-        return bool(list(filter(lambda p: p <= now and p > last_sent, timepoints)))
+        return bisect_right(minutes, lower) < bisect_right(minutes, now.hour * 60 + now.minute)
 
-    def run_if_should(self, objects, manager):
+    def run_if_should(self, objects, manager, queue):
         for object in objects:
-            if object and self.should_run(object):
-                manager.run(object)
-                manager.log_request(object)
+            if object is None:
+                continue
+
+            if self.should_run(object):
+                queue.setdefault(object.contract_id, []).append((type(object), object.id, manager))
+            else:
+                object.next_fire_at = manager.calculate_next_fire(object)
+
+    def dispatch(self, app, queue):
+        # one worker per contract keeps the order of its notifications
+        futures = [self.executor.submit(self.send_queued, app, items) for items in queue.values()]
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                log(e, True)
+
+    def send_queued(self, app, items):
+        # request rows are committed together with the queued notifications, before the outbox sends them,
+        # so log_done always finds them and nothing is counted as sent if the worker dies halfway
+        with app.app_context():
+            requests = []
+
+            for model, object_id, manager in items:
+                object = None
 
-    def update_daily_tasks(self, app):
-        print("Start tasks update")
+                try:
+                    object = model.query.filter_by(id=object_id).first()
+                    manager.run(object, commit=False)
+                    manager.log_request(object, buffer=requests)
+                    object.next_fire_at = manager.calculate_next_fire(object)
+                except Exception as e:
+                    log(e, True)
+
+                    # the failed point is skipped instead of retried every tick
+                    if object is not None:
+                        try:
+                            object.next_fire_at = manager.calculate_next_fire(
+                                object, since=timezone_now(object.contract.get_actual_timezone()))
+                        except Exception as e:
+                            log(e, True)
+
+            self.flush_requests(requests)
+            self.__commit__()
+
+    def get_due(self, model, shard=None, shards=1):
+        query = model.query.join(Contract, model.contract_id == Contract.id).filter(
+            (Contract.is_active == True) & (model.next_fire_at <= datetime.utcnow()))
+
+        if shard is not None:
+            query = query.filter(model.contract_id % shards == shard)
+
+        return list(query.all())
+
+    def update_schedule(self, app):
+        with app.app_context():
+            for contracts in self.iterate_active_contracts('medicines', 'forms', 'reminders'):
+                for contract in contracts:
+                    for object in contract.medicines + contract.forms + contract.reminders:
+                        object.next_fire_at = self.calculate_next_fire(object)
+
+                self.__commit__()
+                self.db.session.expunge_all()
+
+    def get_daily_tasks(self, contract):
+        # finish_task counts the day's progress on the task itself, so a task is never carried over to the next
+        # day; the date in the state makes the nightly run recreate all of them and same-day reruns skip them
+        today = timezone_now(contract.get_actual_timezone()).date().isoformat()
+        tasks = {}
+
+        for form in filter(lambda f: self.should_run(f, True), contract.forms):
+            tasks['form-{}'.format(form.id)] = [form.title, self.count_times(form), 'form/{}'.format(form.id), today]
+
+        for medicine in filter(lambda m: self.should_run(m, True), contract.medicines):
+            tasks['medicine-{}'.format(medicine.id)] = [medicine.title, self.count_times(medicine),
+                                                        'medicine/{}'.format(medicine.id), today]
+
+        return tasks
+
+    def is_synced(self, key, state, desired):
+        return key in desired and state.get(key) == desired[key]
+
+    def sync_daily_tasks(self, contract_id, current, state, desired):
+        # runs in a worker thread, so it must not touch the session;
+        # every call is accounted for on its own, a failed one is retried by the next run
+        tasks = {}
+        tasks_state = {}
+        calls = []
+
+        for key, task_id in current.items():
+            if self.is_synced(key, state, desired):
+                tasks[key] = task_id
+                tasks_state[key] = desired[key]
+            else:
+                calls.append((key, task_id, ('delete_task', (contract_id, task_id))))
+
+        for key, (title, target_number, action_link, day) in desired.items():
+            if key not in tasks:
+                calls.append((key, None, ('add_task', (contract_id, title),
+                                          {"target_number": target_number, "action_link": action_link})))
+
+        for (key, task_id, call), result in zip(calls, self.gather(call for key, task_id, call in calls)):
+            if task_id is not None and result is None:
+                # still exists upstream, kept without a state so that it is deleted next time
+                tasks['stale-{}'.format(task_id)] = task_id
+            elif task_id is None and isinstance(result, dict) and 'task_id' in result:
+                tasks[key] = result['task_id']
+                tasks_state[key] = desired[key]
+
+        return {"id": contract_id, "tasks": tasks, "tasks_state": tasks_state}
+
+    def update_daily_tasks(self, app, hour=3):
         with app.app_context():
+            where = self.local_hour_filter(hour)
 
-            contracts = list(Contract.query.filter_by(is_active=True).all())
+            if where is None:
+                return
 
-            for contract in contracts:
+            print("Start tasks update")
+            futures = []
+
+            for contracts in self.iterate_active_contracts('forms', 'medicines', where=where):
+                for contract in contracts:
+                    try:
+                        desired = self.get_daily_tasks(contract)
+                        current = contract.tasks or {}
+                        state = contract.tasks_state or {}
+
+                        if any(key not in current or not self.is_synced(key, state, desired)
+                               for key in set(current) | set(desired)):
+                            futures.append(self.executor.submit(self.sync_daily_tasks, contract.id, current, state,
+                                                                desired))
+                    except Exception as e:
+                        log(e, True)
+
+                # nothing is changed through the session here, the rows are written in bulk below
+                self.db.session.expunge_all()
+
+            rows = []
+
+            for future in futures:
                 try:
-                    daily_forms = list(filter(lambda f: self.should_run(f, True), contract.forms))
-                    daily_medicines = list(filter(lambda m: self.should_run(m, True), contract.medicines))
-
-                    if contract.tasks is not None:
-                        for task_id in contract.tasks.values():
-                            self.medsenger_api.delete_task(contract.id, task_id)
-
-                    tasks = {}
-
-                    for form in daily_forms:
-                        task = self.medsenger_api.add_task(contract.id, form.title,
-                                                           target_number=self.count_times(form),
-                                                           action_link='form/{}'.format(form.id))
-                        if task is not None:
-                            tasks.update({'form-{}'.format(form.id): task['task_id']})
-
-                    for medicine in daily_medicines:
-                        task = self.medsenger_api.add_task(contract.id, medicine.title,
-                                                           target_number=self.count_times(medicine),
-                                                           action_link='medicine/{}'.format(medicine.id))
-                        if task is not None:
-                            tasks.update({'medicine-{}'.format(medicine.id): task['task_id']})
-
-                    contract.tasks = tasks
-                    self.__commit__()
+                    rows.append(future.result())
                 except Exception as e:
                     log(e, True)
 
+            for i in range(0, len(rows), 500):
+                self.db.session.execute(update(Contract), rows[i:i + 500])
+                self.__commit__()
+
     def count_times(self, obj):
         now = timezone_now(obj.contract.get_actual_timezone())
-        timetable = obj.timetable
-        points = timetable['points']
+        return len(get_day_minutes(obj.get_compiled_timetable(), now.date()))
 
-        if timetable['mode'] == 'weekly':
-            return len(list(filter(lambda x: x['day'] == now.weekday(), points)))
-        if timetable['mode'] == 'monthly':
-            return len(list(filter(lambda x: x['day'] == now.day, points)))
+    def get_algorithm_ids(self, category, where=None):
+        query = self.db.session.query(Algorithm.id).join(Contract, Contract.id == Algorithm.contract_id).filter(
+            (Contract.is_active == True) & Algorithm.categories.like('%{}%'.format(category)))
 
-        return len(points)
+        if where is not None:
+            query = query.filter(where)
 
-    def check_hours(self, app):
+        return [row.id for row in query.order_by(Algorithm.id)]
+
+    def dispatch_algorithms(self, algorithm_ids, included_categories=[], excluded_categories=[]):
+        from celery import group
         from tasks import tasks
 
-        with app.app_context():
-            contracts = list(Contract.query.filter_by(is_active=True).all())
-            algorithm_groups = list(map(lambda x: x.algorithms, contracts))
+        if not algorithm_ids:
+            return
 
-            for group in algorithm_groups:
-                for alg in group:
-                    if "exact_time" in alg.categories:
-                        tasks.run_algorithm.s(True, alg.id).apply_async()
+        # small chunks spread one check over every celery worker instead of a few long serial tasks
+        group(tasks.run_algorithms.s(True, algorithm_ids[i:i + ALGORITHM_CHUNK_SIZE], included_categories,
+                                     excluded_categories)
+              for i in range(0, len(algorithm_ids), ALGORITHM_CHUNK_SIZE)).apply_async()
 
-    def check_days(self, app):
-        from tasks import tasks
+    def check_hours(self, app):
+        with app.app_context():
+            algorithm_ids = self.get_algorithm_ids("exact_time")
 
+        self.dispatch_algorithms(algorithm_ids)
+
+    def check_days(self, app, hour=7):
         with app.app_context():
-            contracts = list(Contract.query.filter_by(is_active=True).all())
-            algorithm_groups = list(map(lambda x: x.algorithms, contracts))
+            where = self.local_hour_filter(hour)
+
+            if where is None:
+                return
 
-            for group in algorithm_groups:
-                for alg in group:
-                    if "exact_date" in alg.categories:
-                        tasks.run_algorithm.s(True, alg.id, ["exact_date"], []).apply_async()
+            algorithm_ids = self.get_algorithm_ids("exact_date", where)
 
-    def iterate(self, app):
+        self.dispatch_algorithms(algorithm_ids, ["exact_date"], [])
+
+    def iterate(self, app, shard=None, shards=1):
         with app.app_context():
-            contracts = list(Contract.query.filter_by(is_active=True).all())
+            queue = {}
 
-            medicines_groups = list(map(lambda x: x.medicines, contracts))
-            forms_groups = list(map(lambda x: x.forms, contracts))
-            reminders_groups = list(map(lambda x: x.reminders, contracts))
+            self.run_if_should(self.get_due(Medicine, shard, shards), self.medicine_manager, queue)
+            self.run_if_should(self.get_due(Form, shard, shards), self.form_manager, queue)
+            self.run_if_should(self.get_due(Reminder, shard, shards), self.reminder_manager, queue)
+            self.__commit__()
 
-            for medicines in medicines_groups:
-                self.run_if_should(medicines, self.medicine_manager)
+        self.dispatch(app, queue)
 
-            for forms in forms_groups:
-                self.run_if_should(forms, self.form_manager)
+    def get_forgotten(self, model):
+        now = int(time.time())
 
-            for reminders in reminders_groups:
-                self.run_if_should(reminders, self.reminder_manager)
+        return model.query.join(Contract, Contract.id == model.contract_id).filter(
+            (Contract.is_active == True) & (model.warning_days > 0) & (model.warning_timestamp == 0) &
+            (model.asked_timestamp > 0) & (model.asked_timestamp < now - 24 * 60 * 60 * model.warning_days)).all()
 
     def check_forgotten(self, app):
         with app.app_context():
-            contracts = list(Contract.query.filter_by(is_active=True).all())
-            medicine_manager = MedicineManager(self.medsenger_api, self.db)
-            form_manager = FormManager(self.medsenger_api, self.db)
-
-            medicines_groups = list(map(lambda x: x.medicines, contracts))
-            forms_groups = list(map(lambda x: x.forms, contracts))
+            for model, manager in [(Medicine, self.medicine_manager), (Form, self.form_manager)]:
+                for obj in self.get_forgotten(model):
+                    warning = manager.get_warning(obj)
 
-            for medicines in medicines_groups:
-                for medicine in medicines:
-                    medicine_manager.check_warning(medicine)
+                    if warning:
+                        contract_id, text, params = warning
+                        self.outbox.send_message(contract_id, text, **params)
 
-            for forms in forms_groups:
-                for form in forms:
-                    form_manager.check_warning(form)
+            self.__commit__()
 
     def worker(self, app):
         while True:
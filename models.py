@@ -1,39 +1,126 @@
 import time
 from datetime import datetime, timedelta, date
-from functools import reduce
-from pytz import timezone, FixedOffset
+from pytz import FixedOffset
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
 from sqlalchemy.orm import backref
-from helpers import get_step, clear_categories
+from helpers import get_step, clear_categories, get_timezone, compile_timetable
 
 db = SQLAlchemy()
 
 
 class Compliance:
+    @staticmethod
+    def month_start():
+        return datetime.now().replace(day=1, minute=0, hour=0, second=0)
+
+    @staticmethod
+    def week_start():
+        return datetime.now() - timedelta(days=7)
+
+    @staticmethod
+    def group_compliance(objects, start_date=None, end_date=None):
+        keys = {(obj.contract_id, obj.get_compliance_action()) for obj in objects if obj.contract_id}
+        return Compliance.query_compliance(keys, start_date, end_date)
+
+    @staticmethod
+    def query_compliance(keys, start_date=None, end_date=None):
+        # counted by calendar day, so the week covers today and the seven days before it in full;
+        # action_request is only read while the rollup has nothing for the range, e.g. before the first rebuild
+        if not keys:
+            return {}
+
+        contract_ids = {contract_id for contract_id, action in keys}
+        actions = {action for contract_id, action in keys}
+
+        request = db.session.query(ComplianceRollup.contract_id, ComplianceRollup.action,
+                                   func.sum(ComplianceRollup.sent), func.sum(ComplianceRollup.done)).filter(
+            ComplianceRollup.contract_id.in_(contract_ids) & ComplianceRollup.action.in_(actions))
+
+        if start_date:
+            request = request.filter(ComplianceRollup.day >= start_date.date())
+
+        if end_date:
+            request = request.filter(ComplianceRollup.day <= end_date.date())
+
+        rows = request.group_by(ComplianceRollup.contract_id, ComplianceRollup.action).all()
+
+        if not rows:
+            request = db.session.query(ActionRequest.contract_id, ActionRequest.action, func.count(),
+                                       func.count().filter(ActionRequest.is_done == True)).filter(
+                ActionRequest.contract_id.in_(contract_ids) & ActionRequest.action.in_(actions))
+
+            if start_date:
+                request = request.filter(ActionRequest.sent >= datetime.combine(start_date.date(), datetime.min.time()))
+
+            if end_date:
+                request = request.filter(ActionRequest.sent < datetime.combine(end_date.date() + timedelta(days=1),
+                                                                               datetime.min.time()))
+
+            rows = request.group_by(ActionRequest.contract_id, ActionRequest.action).all()
+
+        return {(contract_id, action): (sent, done) for contract_id, action, sent, done in rows
+                if (contract_id, action) in keys}
+
+    @staticmethod
+    def sum_compliance(objects, compliance):
+        result = [0, 0]
+
+        for obj in objects:
+            sent, done = compliance.get((obj.contract_id, obj.get_compliance_action()), (0, 0))
+            result[0] += sent
+            result[1] += done
+
+        return result
+
+    def get_compliance_action(self):
+        if isinstance(self, Form):
+            return "form_{}".format(self.id)
+        if isinstance(self, Medicine):
+            return "medicine_{}".format(self.id)
+
+        return None
+
+    def add_compliance(self, serialized, compliance=None, include=()):
+        # sent and done cost a query per object unless the caller passes a compliance map
+        if compliance is not None or 'sent' in include or 'done' in include:
+            serialized['sent'], serialized['done'] = self.get_month_compliance(compliance)
+
+        return serialized
+
+    def get_month_compliance(self, compliance=None):
+        if compliance is not None:
+            return compliance.get((self.contract_id, self.get_compliance_action()), (0, 0))
+
+        if self.contract_id:
+            return self.current_month_compliance()
+
+        return 0, 0
+
     def current_month_compliance(self, action=None):
-        return self.count_compliance(action, start_date=datetime.now().replace(day=1, minute=0, hour=0, second=0))
+        return self.count_compliance(action, start_date=self.month_start())
 
     def current_week_compliance(self, action=None):
-        return self.count_compliance(action, start_date=datetime.now() - timedelta(days=7))
+        return self.count_compliance(action, start_date=self.week_start())
 
     def count_compliance(self, action=None, start_date=None, end_date=None):
         if not action:
-            if isinstance(self, Form):
-                action = "form_{}".format(self.id)
-            if isinstance(self, Medicine):
-                action = "medicine_{}".format(self.id)
+            action = self.get_compliance_action()
 
-        request = ActionRequest.query.filter_by(contract_id=self.contract_id, action=action)
+        key = (self.contract_id, action)
+        return Compliance.query_compliance({key}, start_date, end_date).get(key, (0, 0))
 
-        if start_date:
-            request = request.filter(ActionRequest.sent >= start_date)
 
-        if end_date:
-            request = request.filter(ActionRequest.sent <= end_date)
+class Scheduled:
+    def get_compiled_timetable(self):
+        cached = getattr(self, '_compiled_timetable', None)
 
-        records = request.all()
+        # timetable is replaced, not mutated, on edit, so identity is enough to detect changes
+        if cached is None or cached[0] is not self.timetable:
+            cached = (self.timetable, compile_timetable(self.timetable or {}))
+            self._compiled_timetable = cached
 
-        return len(records), len(list(filter(lambda x: x.is_done, records)))
+        return cached[1]
 
 
 # models
@@ -47,60 +134,58 @@ class Patient(db.Model):
     examinations = db.relationship('MedicalExamination', backref=backref('patient', uselist=False), lazy=True)
 
     def as_dict(self):
-        today = datetime.now()
-        today = today.date()
+        today = datetime.now().date()
+        compliance = Compliance.group_compliance(self.get_compliance_objects(), start_date=Compliance.month_start())
+
+        medicines = {(False, False): [], (True, False): [], (False, True): [], (True, True): []}
+        for medicine in self.medicines:
+            medicines[(medicine.canceled_at is not None, bool(medicine.is_created_by_patient))].append(medicine)
+
+        examinations, expired_examinations = [], []
+        for examination in sorted(self.examinations, key=lambda k: k.deadline_date):
+            (examinations if examination.deadline_date >= today else expired_examinations).append(examination)
+
+        reminders, old_reminders = [], []
+        for reminder in self.reminders:
+            (reminders if reminder.canceled_at is None else old_reminders).append(reminder)
+
         return {
             "id": self.id,
-            "month_compliance": self.count_month_compliance(),
+            "month_compliance": self.count_month_compliance(compliance),
             "contracts": [contract.as_dict() for contract in self.contracts],
-            "forms": [form.as_dict() for form in self.forms],
-            "examinations": [examination.as_dict() for examination in sorted(self.examinations, key=lambda k: k.deadline_date) if
-                             examination.deadline_date >= today],
-            "expired_examinations": [examination.as_dict() for examination in sorted(self.examinations, key=lambda k: k.deadline_date) if
-                                     examination.deadline_date < today],
-            "medicines": sorted([medicine.as_dict() for medicine in self.medicines if
-                                 medicine.canceled_at is None and not medicine.is_created_by_patient],
-                                key=lambda m: m['title']),
-            "canceled_medicines": sorted([medicine.as_dict() for medicine in self.medicines if
-                                          medicine.canceled_at is not None and not medicine.is_created_by_patient],
-                                         key=lambda m: m['title']),
-            "patient_medicines": [medicine.as_dict() for medicine in self.medicines if
-                                  medicine.canceled_at is None and medicine.is_created_by_patient],
-            "canceled_patient_medicines": [medicine.as_dict() for medicine in self.medicines if
-                                           medicine.canceled_at is not None and medicine.is_created_by_patient],
-            "reminders": [reminder.as_dict() for reminder in sorted(self.reminders, key=lambda k: k.attach_date) if
-                          reminder.canceled_at is None],
-            "old_reminders": [reminder.as_dict() for reminder in sorted(self.reminders, key=lambda k: k.attach_date, reverse=True) if
-                          reminder.canceled_at is not None],
+            "forms": [form.as_dict(compliance) for form in self.forms],
+            "examinations": [examination.as_dict() for examination in examinations],
+            "expired_examinations": [examination.as_dict() for examination in expired_examinations],
+            "medicines": [medicine.as_dict(compliance) for medicine in
+                          sorted(medicines[(False, False)], key=lambda m: m.title)],
+            "canceled_medicines": [medicine.as_dict(compliance) for medicine in
+                                   sorted(medicines[(True, False)], key=lambda m: m.title)],
+            "patient_medicines": [medicine.as_dict(compliance) for medicine in medicines[(False, True)]],
+            "canceled_patient_medicines": [medicine.as_dict(compliance) for medicine in medicines[(True, True)]],
+            "reminders": [reminder.as_dict() for reminder in sorted(reminders, key=lambda k: k.attach_date)],
+            "old_reminders": [reminder.as_dict() for reminder in
+                              sorted(old_reminders, key=lambda k: k.attach_date, reverse=True)],
             "algorithms": [algorithm.as_dict() for algorithm in self.algorithms]
         }
 
-    def count_month_compliance(self):
-        def sum_compliance(compliance, object):
-            sent, done = object.current_month_compliance()
-            compliance[0] += sent
-            compliance[1] += done
-            return compliance
+    def get_compliance_objects(self):
+        return list(self.forms) + list(self.medicines)
 
-        return reduce(sum_compliance, list(self.forms) + list(self.medicines), [0, 0])
+    def count_month_compliance(self, compliance=None):
+        objects = self.get_compliance_objects()
 
-    def count_week_compliance(self):
-        def sum_compliance(compliance, object):
-            sent, done = object.current_week_compliance()
-            compliance[0] += sent
-            compliance[1] += done
-            return compliance
+        if compliance is None:
+            compliance = Compliance.group_compliance(objects, start_date=Compliance.month_start())
 
-        return reduce(sum_compliance, list(self.forms) + list(self.medicines), [0, 0])
+        return Compliance.sum_compliance(objects, compliance)
 
-    def count_full_compliance(self):
-        def sum_compliance(compliance, object):
-            sent, done = object.count_compliance()
-            compliance[0] += sent
-            compliance[1] += done
-            return compliance
+    def count_week_compliance(self):
+        objects = self.get_compliance_objects()
+        return Compliance.sum_compliance(objects, Compliance.group_compliance(objects, start_date=Compliance.week_start()))
 
-        return reduce(sum_compliance, list(self.forms) + list(self.medicines), [0, 0])
+    def count_full_compliance(self):
+        objects = self.get_compliance_objects()
+        return Compliance.sum_compliance(objects, Compliance.group_compliance(objects))
 
 
 class Contract(db.Model):
@@ -117,6 +202,7 @@ class Contract(db.Model):
     algorithms = db.relationship('Algorithm', backref=backref('contract', uselist=False), lazy=True)
     examinations = db.relationship('MedicalExamination', backref=backref('contract', uselist=False), lazy=True)
     tasks = db.Column(db.JSON, nullable=True)
+    tasks_state = db.Column(db.JSON, nullable=True)
 
     is_admin = db.Column(db.Boolean, default=False)
     clinic_timezone = db.Column(db.String(255), nullable=True)
@@ -137,7 +223,7 @@ class Contract(db.Model):
         if not self.clinic_timezone:
             return None
 
-        return timezone(self.clinic_timezone)
+        return get_timezone(self.clinic_timezone)
 
     def get_patient_timezone(self):
         if self.patient_timezone_offset is None:
@@ -159,7 +245,7 @@ class Contract(db.Model):
         return zone
 
 
-class Medicine(db.Model, Compliance):
+class Medicine(db.Model, Compliance, Scheduled):
     id = db.Column(db.Integer, primary_key=True)
 
     template_id = db.Column(db.Integer, db.ForeignKey('medicine.id', ondelete="set null"), nullable=True)
@@ -186,6 +272,7 @@ class Medicine(db.Model, Compliance):
     prescription_history = db.Column(db.JSON, nullable=True)
 
     last_sent = db.Column(db.DateTime(), nullable=True)
+    next_fire_at = db.Column(db.DateTime(), nullable=True, index=True)
 
     warning_days = db.Column(db.Integer, default=0)
     warning_timestamp = db.Column(db.Integer, default=0)
@@ -193,18 +280,29 @@ class Medicine(db.Model, Compliance):
     asked_timestamp = db.Column(db.Integer, default=0)
     detach_date = db.Column(db.Date, nullable=True)
 
+    # only rows still waiting for a warning, used by check_forgotten
+    __table_args__ = (
+        db.Index('ix_medicine_pending_warning', 'asked_timestamp',
+                 postgresql_where=(warning_days > 0) & (warning_timestamp == 0) & (asked_timestamp > 0),
+                 sqlite_where=(warning_days > 0) & (warning_timestamp == 0) & (asked_timestamp > 0)),
+    )
+
     prescribed_at = db.Column(db.DateTime, server_default=db.func.now())
     canceled_at = db.Column(db.DateTime, nullable=True)
 
     medicine_database_id = db.Column(db.Integer, nullable=True)
 
-    def as_dict(self):
-        if self.contract_id:
-            sent, done = self.current_month_compliance()
-        else:
-            sent, done = 0, 0
-
+    def as_summary(self):
         return {
+            "id": self.id,
+            "title": self.title,
+            "dose": self.dose,
+            "rules": self.rules,
+            "template_category": self.template_category
+        }
+
+    def as_dict(self, compliance=None, include=()):
+        return self.add_compliance({
             "id": self.id,
             "contract_id": self.contract_id,
             "patient_id": self.patient_id,
@@ -227,10 +325,8 @@ class Medicine(db.Model, Compliance):
             "detach_date": self.detach_date.strftime('%Y-%m-%d') if self.detach_date else None,
             "prescribed_at": self.prescribed_at.strftime("%d.%m.%Y"),
             "canceled_at": self.canceled_at.strftime("%d.%m.%Y") if self.canceled_at else None,
-            "sent": sent,
-            "done": done,
             "medicine_database_id": self.medicine_database_id
-        }
+        }, compliance, include)
 
     def timetable_description(self):
         if self.timetable['mode'] == 'daily':
@@ -282,7 +378,7 @@ class Medicine(db.Model, Compliance):
         return new_medicine
 
 
-class Form(db.Model, Compliance):
+class Form(db.Model, Compliance, Scheduled):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete="CASCADE"), nullable=True)
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id', ondelete="CASCADE"), nullable=True)
@@ -316,12 +412,19 @@ class Form(db.Model, Compliance):
     exclude_clinics = db.Column(db.JSON, nullable=True)
 
     last_sent = db.Column(db.DateTime(), nullable=True)
+    next_fire_at = db.Column(db.DateTime(), nullable=True, index=True)
 
     warning_days = db.Column(db.Integer, default=0)
     warning_timestamp = db.Column(db.Integer, default=0)
     filled_timestamp = db.Column(db.Integer, default=0)
     asked_timestamp = db.Column(db.Integer, default=0)
 
+    __table_args__ = (
+        db.Index('ix_form_pending_warning', 'asked_timestamp',
+                 postgresql_where=(warning_days > 0) & (warning_timestamp == 0) & (asked_timestamp > 0),
+                 sqlite_where=(warning_days > 0) & (warning_timestamp == 0) & (asked_timestamp > 0)),
+    )
+
     template_category = db.Column(db.String(512), default="Общее", nullable=True)
     instant_report = db.Column(db.Boolean, default=False, nullable=False, server_default='false')
 
@@ -340,13 +443,16 @@ class Form(db.Model, Compliance):
     def get_description(self):
         return f"{self.title} ({self.timetable_description()})"
 
-    def as_dict(self):
-        if self.contract_id:
-            sent, done = self.current_month_compliance()
-        else:
-            sent, done = 0, 0
-
+    def as_summary(self):
         return {
+            "id": self.id,
+            "title": self.title,
+            "doctor_description": self.doctor_description,
+            "template_category": self.template_category
+        }
+
+    def as_dict(self, compliance=None, include=()):
+        return self.add_compliance({
             "id": self.id,
             "contract_id": self.contract_id,
             "patient_id": self.patient_id,
@@ -371,10 +477,8 @@ class Form(db.Model, Compliance):
             "template_category": self.template_category,
             "instant_report": self.instant_report,
             "clinics": self.clinics,
-            "exclude_clinics": self.exclude_clinics,
-            "sent": sent,
-            "done": done
-        }
+            "exclude_clinics": self.exclude_clinics
+        }, compliance, include)
 
     def clone(self):
         new_form = Form()
@@ -423,12 +527,28 @@ class Algorithm(db.Model):
     template_id = db.Column(db.Integer, db.ForeignKey('algorithm.id', ondelete="set null"), nullable=True)
     attached_form = db.Column(db.Integer, nullable=True)
 
+    # scheduled algorithms, used by check_hours and check_days
+    __table_args__ = (
+        db.Index('ix_algorithm_exact_time', 'contract_id', postgresql_where=categories.like('%exact_time%'),
+                 sqlite_where=categories.like('%exact_time%')),
+        db.Index('ix_algorithm_exact_date', 'contract_id', postgresql_where=categories.like('%exact_date%'),
+                 sqlite_where=categories.like('%exact_date%')),
+    )
+
     template_category = db.Column(db.String(512), default="Общее", nullable=True)
     clinics = db.Column(db.JSON, nullable=True)
 
     attach_date = db.Column(db.Date, nullable=True)
     detach_date = db.Column(db.Date, nullable=True)
 
+    def as_summary(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "description": self.description,
+            "template_category": self.template_category
+        }
+
     def as_dict(self, native=False):
         return {
             "id": self.id,
@@ -521,8 +641,61 @@ class ActionRequest(db.Model):
     sent = db.Column(db.DateTime(), default=db.func.current_timestamp())
     done = db.Column(db.DateTime(), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_action_request_contract_action_id', contract_id, action, id),
+        db.Index('ix_action_request_contract_action_sent', contract_id, action, sent),
+    )
+
+
+class ActionRequestArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id', ondelete="CASCADE"), nullable=True, index=True)
+
+    action = db.Column(db.String(255), nullable=True)
+    description = db.Column(db.Text, nullable=True)
+
+    is_done = db.Column(db.Boolean, default=False)
+
+    sent = db.Column(db.DateTime(), nullable=True)
+    done = db.Column(db.DateTime(), nullable=True)
+
+
+class ComplianceRollup(db.Model):
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id', ondelete="CASCADE"), primary_key=True)
+    action = db.Column(db.String(255), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+
+    sent = db.Column(db.Integer, default=0, nullable=False)
+    done = db.Column(db.Integer, default=0, nullable=False)
+
 
-class Reminder(db.Model):
+class Outbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, nullable=True)
+
+    method = db.Column(db.String(32), nullable=False)
+    args = db.Column(db.JSON, nullable=True)
+    kwargs = db.Column(db.JSON, nullable=True)
+
+    created_at = db.Column(db.DateTime(), default=db.func.current_timestamp())
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime(), nullable=True)
+    sent_at = db.Column(db.DateTime(), nullable=True)
+    failed_at = db.Column(db.DateTime(), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    # a sender owns the rows it claimed until the lease runs out
+    claimed_by = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime(), nullable=True)
+
+    # the sender only ever reads the rows still waiting to go out, oldest first per contract
+    __table_args__ = (
+        db.Index('ix_outbox_pending', 'contract_id', 'id', postgresql_where=(sent_at == None) & (failed_at == None),
+                 sqlite_where=(sent_at == None) & (failed_at == None)),
+    )
+
+
+class Reminder(db.Model, Scheduled):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete="CASCADE"), nullable=True)
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id', ondelete="CASCADE"), nullable=True)
@@ -532,6 +705,7 @@ class Reminder(db.Model):
     timetable = db.Column(db.JSON, nullable=True)
 
     last_sent = db.Column(db.DateTime(), nullable=True)
+    next_fire_at = db.Column(db.DateTime(), nullable=True, index=True)
     send_next = db.Column(db.DateTime(), nullable=True)
 
     type = db.Column(db.String(7), nullable=False)
@@ -560,6 +734,13 @@ class Reminder(db.Model):
         description += ' в течение {} дней'.format(abs(delta.days))
         return description
 
+    def as_summary(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "text": self.text
+        }
+
     def as_dict(self):
         return {
             "id": self.id,
@@ -669,6 +850,14 @@ class MedicalExamination(db.Model):
 
         return new_examination
 
+    def as_summary(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "doctor_description": self.doctor_description,
+            "template_category": self.template_category
+        }
+
     def as_dict(self):
         return {
             "id": self.id,
@@ -0,0 +1,47 @@
+import json
+
+from helpers import log
+from models import Outbox
+
+
+def has_inline_files(kwargs):
+    return any(isinstance(attachment, dict) and attachment.get('base64')
+               for attachment in kwargs.get('attachments') or [])
+
+
+class OutboxClient:
+    # fire-and-forget calls are stored in the caller's transaction and sent later by forms_outbox.py,
+    # everything else goes straight to medsenger_api; send_file_by_link is resolved by the sender
+    methods = ['send_message', 'add_record', 'send_order', 'update_cache', 'send_file_by_link']
+
+    def __init__(self, medsenger_api, db):
+        self.medsenger_api = medsenger_api
+        self.db = db
+
+    def __getattr__(self, name):
+        if name in self.methods:
+            return lambda *args, **kwargs: self.enqueue(name, *args, **kwargs)
+
+        return getattr(self.medsenger_api, name)
+
+    def enqueue(self, method, *args, **kwargs):
+        # nothing is known about delivery yet, so queued calls return None; the sender tracks it on the row
+        # file contents would bloat the table and its WAL, such calls are not worth retrying later
+        if has_inline_files(kwargs):
+            return getattr(self.medsenger_api, method)(*args, **kwargs)
+
+        try:
+            json.dumps([args, kwargs])
+        except (TypeError, ValueError) as e:
+            log(e)
+            return getattr(self.medsenger_api, method)(*args, **kwargs)
+
+        contract_id = args[0] if args else kwargs.get('contract_id')
+
+        try:
+            contract_id = int(contract_id)
+        except (TypeError, ValueError):
+            contract_id = None
+
+        # goes out with the caller's commit and is dropped with its rollback
+        self.db.session.add(Outbox(contract_id=contract_id, method=method, args=list(args), kwargs=kwargs))
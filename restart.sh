@@ -1,4 +1,5 @@
 supervisorctl restart agents-forms
 supervisorctl restart agents-forms-jobs
+supervisorctl restart agents-forms-outbox
 supervisorctl restart agents-forms-celeryd
 npm run build
@@ -1,3 +1,4 @@
+from helpers import log
 from manage import app, celery, form_manager, algorithm_manager, examination_manager, contract_manager, medsenger_api
 
 @celery.task
@@ -57,3 +58,19 @@ def run_algorithm(chain, algorithm_id, included_categories=[], excluded_categori
 
     with app.app_context():
         return algorithm_manager.run(algorithm_manager.get(algorithm_id), included_categories, excluded_categories)
+
+
+@celery.task
+def run_algorithms(chain, algorithm_ids, included_categories=[], excluded_categories=[]):
+    if not chain:
+        return chain
+
+    with app.app_context():
+        for algorithm_id in algorithm_ids:
+            try:
+                algorithm_manager.run(algorithm_manager.get(algorithm_id), included_categories, excluded_categories)
+            except Exception as e:
+                algorithm_manager.db.session.rollback()
+                log(e)
+
+        return True
@@ -0,0 +1,93 @@
+# python -m unittest tests.test_archive
+#
+# Needs a scratch postgres database (14 or newer), every table in it is dropped:
+#   FORMS_TEST_POSTGRES=postgresql://postgres@localhost/forms-test python -m unittest tests.test_archive
+
+import os
+import unittest
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from benchmarks.common import StubAgentApiClient, create_app
+from config import ACTION_REQUEST_RETENTION_MONTHS
+from managers.ArchiveManager import ArchiveManager, month_start
+from models import db, Patient, Contract, ActionRequest, ActionRequestArchive, ComplianceRollup
+
+POSTGRES = os.environ.get('FORMS_TEST_POSTGRES')
+
+
+@unittest.skipUnless(POSTGRES, 'FORMS_TEST_POSTGRES is not set')
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(POSTGRES)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.drop()
+        db.create_all()
+
+        self.manager = ArchiveManager(StubAgentApiClient(), db)
+        self.old = month_start(date.today(), -ACTION_REQUEST_RETENTION_MONTHS - 2)
+        old = datetime.combine(self.old, datetime.min.time()) + timedelta(days=3)
+
+        db.session.add(Patient(id=1))
+        db.session.add(Contract(id=1, patient_id=1))
+        db.session.flush()
+
+        for i in range(3):
+            db.session.add(ActionRequest(contract_id=1, action='form_1', sent=old, is_done=i == 0))
+        db.session.add(ActionRequest(contract_id=1, action='form_1', sent=datetime.now()))
+        db.session.commit()
+
+        self.assertTrue(self.manager.convert())
+
+    def tearDown(self):
+        db.session.remove()
+        self.drop()
+        self.context.pop()
+
+    def drop(self):
+        db.session.execute(text("DROP TABLE IF EXISTS action_request CASCADE"))
+        for name in db.session.execute(text(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND relname LIKE 'action\\_request\\_y%'")).scalars():
+            db.session.execute(text("DROP TABLE {}".format(name)))
+        db.session.commit()
+        db.drop_all()
+
+    def test_archive_moves_old_months(self):
+        self.manager.archive(self.app)
+
+        self.assertNotIn(self.old, self.manager.get_partitions())
+        self.assertEqual(self.manager.get_detached(), {})
+        self.assertEqual(ActionRequest.query.count(), 1)
+        self.assertEqual(ActionRequestArchive.query.count(), 3)
+
+        rollup = ComplianceRollup.query.filter(ComplianceRollup.day < month_start(self.old, 1)).one()
+        self.assertEqual((rollup.sent, rollup.done), (3, 1))
+
+    def test_archive_finishes_a_detached_month(self):
+        name = self.manager.partition_name(self.old)
+        self.manager.copy_to_archive(name)
+        db.session.commit()
+        self.manager.detach_partition(name)
+
+        self.manager.archive(self.app)
+
+        self.assertEqual(self.manager.get_detached(), {})
+        self.assertEqual(ActionRequestArchive.query.count(), 3)
+
+    def test_partition_takes_rows_from_default(self):
+        month = month_start(date.today(), 6)
+        db.session.add(ActionRequest(contract_id=1, action='form_1', sent=datetime.combine(month, datetime.min.time())))
+        db.session.commit()
+
+        self.manager.create_partition(month)
+        db.session.commit()
+
+        name = self.manager.partition_name(month)
+        self.assertEqual(db.session.execute(text("SELECT count(*) FROM {}".format(name))).scalar(), 1)
+        self.assertEqual(db.session.execute(text("SELECT count(*) FROM action_request_default")).scalar(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
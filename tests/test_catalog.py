@@ -0,0 +1,68 @@
+# python -m unittest discover tests
+#
+# Run from the repository root with a config.py in place.
+
+import unittest
+
+from benchmarks.common import StubAgentApiClient, create_app
+from managers.CatalogManager import CatalogManager
+from models import db, Patient, Contract, Form, Reminder
+
+
+class GetSummariesTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('sqlite://')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        db.session.add(Patient(id=1))
+        db.session.add(Contract(id=1, patient_id=1, clinic_id=10, is_admin=False))
+
+        # every third template belongs to another doctor and must not break the pages
+        for i in range(1, 31):
+            db.session.add(Form(id=i, is_template=True, title='Form {}'.format(i), template_category='cat',
+                                doctor_id=8 if i % 3 == 0 else None))
+
+        db.session.add(Reminder(id=1, is_template=True, type='patient', text='Drink water'))
+        db.session.add(Reminder(id=2, is_template=True, type='patient', text='Walk'))
+        db.session.commit()
+
+        self.manager = CatalogManager(StubAgentApiClient(), db, {})
+        self.manager.get_doctor_id = lambda contract: 7
+        self.contract = db.session.get(Contract, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_cursor_walks_every_visible_template_once(self):
+        ids, cursor = [], None
+
+        while True:
+            page = self.manager.get_summaries('forms', self.contract, cursor=cursor, limit=7)
+            ids += [item['id'] for item in page['items']]
+            cursor = page['next_cursor']
+
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, [i for i in range(1, 31) if i % 3])
+
+    def test_last_full_page_ends_the_walk(self):
+        page = self.manager.get_summaries('forms', self.contract, cursor=28, limit=1)
+        self.assertEqual([item['id'] for item in page['items']], [29])
+
+        page = self.manager.get_summaries('forms', self.contract, cursor=page['next_cursor'], limit=1)
+        self.assertEqual(page, {"items": [], "next_cursor": None})
+
+    def test_reminders_are_searched_by_text(self):
+        page = self.manager.get_summaries('reminders', self.contract, search='water')
+
+        self.assertEqual([item['id'] for item in page['items']], [1])
+        self.assertFalse(self.manager.supports_category('reminders'))
+
+
+if __name__ == '__main__':
+    unittest.main()
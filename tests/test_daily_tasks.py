@@ -0,0 +1,81 @@
+# python -m unittest discover tests
+#
+# Run from the repository root with a config.py in place.
+
+import unittest
+
+from benchmarks.common import StubAgentApiClient
+from managers.TimetableManager import TimetableManager
+from models import db
+
+
+class TasksApi(StubAgentApiClient):
+    def __init__(self, failing=()):
+        super(TasksApi, self).__init__()
+        self.failing = set(failing)
+        self.next_id = 100
+
+    def __getattr__(self, name):
+        call = super(TasksApi, self).__getattr__(name)
+
+        def wrapper(contract_id, *args, **kwargs):
+            call(contract_id, *args, **kwargs)
+
+            if (name, args[0]) in self.failing:
+                return None
+
+            if name == 'add_task':
+                self.next_id += 1
+                return {"task_id": self.next_id}
+
+            return {}
+
+        return wrapper
+
+
+class SyncDailyTasksTest(unittest.TestCase):
+    desired = {
+        "form-1": ["Form", 2, "form/1", "2026-10-18"],
+        "medicine-1": ["Medicine", 1, "medicine/1", "2026-10-18"],
+    }
+
+    def sync(self, api, current, state):
+        manager = TimetableManager(None, None, None, api, db)
+        return manager.sync_daily_tasks(1, current, state, self.desired)
+
+    def test_same_day_is_kept(self):
+        api = TasksApi()
+        row = self.sync(api, {"form-1": 1, "medicine-1": 2}, dict(self.desired))
+
+        self.assertEqual(api.total(), 0)
+        self.assertEqual(row['tasks'], {"form-1": 1, "medicine-1": 2})
+
+    def test_new_day_recreates_tasks(self):
+        api = TasksApi()
+        yesterday = {key: value[:3] + ["2026-10-17"] for key, value in self.desired.items()}
+        row = self.sync(api, {"form-1": 1, "medicine-1": 2}, yesterday)
+
+        self.assertEqual(api.calls, {"delete_task": 2, "add_task": 2})
+        self.assertEqual(set(row['tasks']), {"form-1", "medicine-1"})
+        self.assertEqual(row['tasks_state'], self.desired)
+
+    def test_failed_calls_are_kept_for_the_next_run(self):
+        api = TasksApi(failing=[('delete_task', 1), ('add_task', 'Medicine')])
+        row = self.sync(api, {"form-1": 1, "old-1": 2}, {"form-1": ["Form", 1, "form/1", "2026-10-17"]})
+
+        # the failed delete stays known, the created task is not lost, the failed add is retried later
+        self.assertEqual(row['tasks']['stale-1'], 1)
+        self.assertNotIn('old-1', row['tasks'])
+        self.assertIn('form-1', row['tasks'])
+        self.assertNotIn('medicine-1', row['tasks'])
+        self.assertEqual(row['tasks_state'], {"form-1": self.desired["form-1"]})
+
+        api = TasksApi()
+        row = self.sync(api, row['tasks'], row['tasks_state'])
+
+        self.assertEqual(api.calls, {"delete_task": 1, "add_task": 1})
+        self.assertEqual(set(row['tasks']), {"form-1", "medicine-1"})
+
+
+if __name__ == '__main__':
+    unittest.main()
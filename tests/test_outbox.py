@@ -0,0 +1,118 @@
+# python -m unittest discover tests
+#
+# Run from the repository root with a config.py in place.
+
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from benchmarks.common import create_app
+from managers.OutboxManager import OutboxManager, BACKOFF_SECONDS, MAX_ATTEMPTS, MAX_BACKOFF_SECONDS
+from models import db, Patient, Contract, Outbox
+from outbox import OutboxClient
+
+
+class MessagesApi:
+    def __init__(self):
+        self.sent = []
+        self.failing = set()
+
+    def send_message(self, contract_id, text, **kwargs):
+        if text in self.failing:
+            return None
+
+        self.sent.append((contract_id, text))
+        return {}
+
+
+class OutboxRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('sqlite://')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        db.session.add(Patient(id=1))
+        db.session.add(Contract(id=1, patient_id=1))
+        db.session.add(Contract(id=2, patient_id=1))
+        db.session.commit()
+
+        self.api = MessagesApi()
+        self.outbox = OutboxClient(self.api, db)
+        self.manager = OutboxManager(self.api, db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def queue(self, contract_id, *texts):
+        for text in texts:
+            self.outbox.send_message(contract_id, text)
+        db.session.commit()
+
+    def drain(self):
+        with patch('managers.OutboxManager.print'):
+            self.manager.drain(self.app)
+        db.session.expire_all()
+
+    def make_due(self):
+        Outbox.query.filter(Outbox.next_attempt_at != None).update({"next_attempt_at": datetime.now()})
+        db.session.commit()
+
+    def row(self, text):
+        return next(row for row in Outbox.query.all() if row.args[1] == text)
+
+    def test_failed_row_holds_back_its_contract_only(self):
+        self.api.failing.add('second')
+        self.queue(1, 'first', 'second', 'third')
+        self.queue(2, 'other')
+
+        self.drain()
+
+        self.assertEqual(self.api.sent, [(1, 'first'), (2, 'other')])
+        self.assertEqual(self.row('second').attempts, 1)
+        self.assertIsNone(self.row('third').sent_at)
+
+        # a backed off contract is not picked up again before its time
+        self.assertEqual(self.manager.get_chains(), [])
+
+        self.api.failing.clear()
+        self.make_due()
+        self.drain()
+
+        self.assertEqual(self.api.sent[2:], [(1, 'second'), (1, 'third')])
+
+    def test_backoff_doubles_up_to_the_limit(self):
+        self.api.failing.add('message')
+        self.queue(1, 'message')
+        delays = []
+
+        for attempt in range(MAX_ATTEMPTS - 1):
+            started = datetime.now()
+            self.drain()
+            delays.append((self.row('message').next_attempt_at - started).total_seconds())
+            self.make_due()
+
+        expected = [min(BACKOFF_SECONDS * 2 ** attempt, MAX_BACKOFF_SECONDS) for attempt in range(MAX_ATTEMPTS - 1)]
+
+        for delay, seconds in zip(delays, expected):
+            self.assertAlmostEqual(delay, seconds, delta=2)
+
+    def test_row_fails_after_the_last_attempt_and_unblocks_the_contract(self):
+        self.api.failing.add('broken')
+        self.queue(1, 'broken', 'next')
+
+        for attempt in range(MAX_ATTEMPTS):
+            self.drain()
+            self.make_due()
+
+        broken = self.row('broken')
+        self.assertEqual(broken.attempts, MAX_ATTEMPTS)
+        self.assertIsNotNone(broken.failed_at)
+        self.assertEqual(self.api.sent, [(1, 'next')])
+        self.assertEqual(self.manager.get_stats()['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# python -m unittest discover tests
+#
+# Run from the repository root with a config.py in place.
+
+import unittest
+from datetime import timedelta
+
+from benchmarks.common import StubAgentApiClient, create_app
+from helpers import timezone_now
+from managers.ReminderManager import ReminderManager
+from models import db, Patient, Contract, Reminder
+
+
+class SetNextDateTest(unittest.TestCase):
+    zone = 'Asia/Vladivostok'
+
+    def setUp(self):
+        self.app = create_app('sqlite://')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        db.session.add(Patient(id=1))
+        db.session.add(Contract(id=1, patient_id=1, is_active=True, clinic_timezone=self.zone))
+        db.session.add(Reminder(id=1, contract_id=1, patient_id=1, type='patient', text='Reminder',
+                                timetable={"mode": "daily", "points": [{"hour": 9, "minute": 0}]}))
+        db.session.commit()
+
+        self.manager = ReminderManager(StubAgentApiClient(), db)
+        self.contract = db.session.get(Contract, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def check(self, type, count, delta):
+        expected = timezone_now(self.zone).replace(tzinfo=None) + delta
+
+        self.assertEqual(self.manager.set_next_date(1, self.contract, type, count), 1)
+        db.session.expire_all()
+
+        reminder = db.session.get(Reminder, 1)
+        self.assertEqual(reminder.state, 'later')
+        self.assertLess(abs(reminder.send_next - expected), timedelta(seconds=5))
+
+        # next_fire_at is utc, so it differs from the local send_next by the zone offset
+        offset = timezone_now(self.zone).utcoffset()
+        self.assertLess(abs(reminder.next_fire_at + offset - reminder.send_next), timedelta(seconds=1))
+
+    def test_hour(self):
+        self.check('hour', 2, timedelta(hours=2))
+
+    def test_day(self):
+        self.check('day', 1, timedelta(days=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
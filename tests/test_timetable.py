@@ -0,0 +1,126 @@
+# python -m unittest discover tests
+#
+# Run from the repository root with a config.py in place.
+
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from benchmarks.common import StubAgentApiClient, create_app
+from helpers import get_timezone
+from managers.FormManager import FormManager
+from managers.MedicineManager import MedicineManager
+from managers.ReminderManager import ReminderManager
+from managers.TimetableManager import TimetableManager
+from models import db, Patient, Contract, Medicine, ActionRequest
+
+ZONE = 'Europe/Moscow'
+NOW = get_timezone(ZONE).localize(datetime(2026, 10, 18, 12, 0, 30))
+
+
+def daily(*points):
+    return {"mode": "daily", "points": [{"hour": hour, "minute": minute} for hour, minute in points]}
+
+
+@patch('managers.Manager.timezone_now', lambda zone=None: NOW)
+@patch('managers.TimetableManager.timezone_now', lambda zone=None: NOW)
+class TimetableTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('sqlite://')
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        db.session.add(Patient(id=1))
+        db.session.add(Contract(id=1, patient_id=1, is_active=True, clinic_timezone=ZONE))
+        db.session.commit()
+
+        api = StubAgentApiClient()
+        self.medicine_manager = MedicineManager(api, db)
+        self.manager = TimetableManager(self.medicine_manager, FormManager(api, db), ReminderManager(api, db),
+                                        api, db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def medicine(self, timetable, **kwargs):
+        medicine = Medicine(contract_id=1, patient_id=1, title='Medicine', dose='1', timetable=timetable, **kwargs)
+        db.session.add(medicine)
+        db.session.commit()
+        return medicine
+
+    def test_next_fire_is_the_next_point_in_utc(self):
+        medicine = self.medicine(daily((9, 0), (12, 30), (20, 0)))
+
+        self.assertEqual(self.medicine_manager.calculate_next_fire(medicine), datetime(2026, 10, 18, 9, 30))
+
+    def test_next_fire_moves_to_the_next_day(self):
+        medicine = self.medicine(daily((9, 0)))
+
+        self.assertEqual(self.medicine_manager.calculate_next_fire(medicine), datetime(2026, 10, 19, 6, 0))
+
+    def test_no_next_fire_without_notifications(self):
+        self.assertIsNone(self.medicine_manager.calculate_next_fire(self.medicine({"mode": "manual"})))
+        self.assertIsNone(self.medicine_manager.calculate_next_fire(
+            self.medicine(daily((13, 0)), canceled_at=datetime(2026, 10, 1))))
+
+    def test_missing_objects_are_skipped(self):
+        medicine = self.medicine(daily((13, 0)))
+        queue = {}
+
+        self.manager.run_if_should([None, medicine], self.medicine_manager, queue)
+
+        self.assertEqual(queue, {})
+        self.assertEqual(medicine.next_fire_at, datetime(2026, 10, 18, 10, 0))
+
+    def test_should_run_a_point_passed_since_the_last_send(self):
+        self.assertTrue(self.manager.should_run(self.medicine(daily((9, 0), (11, 58)))))
+
+    def test_should_not_run_a_future_or_stale_point(self):
+        # without a last send only the last five minutes count
+        self.assertFalse(self.manager.should_run(self.medicine(daily((12, 1)))))
+        self.assertFalse(self.manager.should_run(self.medicine(daily((11, 50)))))
+
+    def test_should_not_run_a_point_already_sent(self):
+        medicine = self.medicine(daily((11, 58)))
+        medicine.last_sent = NOW.replace(hour=11, minute=59)
+
+        self.assertFalse(self.manager.should_run(medicine))
+
+        medicine.last_sent = NOW.replace(hour=11, minute=57)
+
+        self.assertTrue(self.manager.should_run(medicine))
+
+    def test_failed_send_skips_the_point(self):
+        def fail(*args, **kwargs):
+            raise RuntimeError('upstream is down')
+
+        medicine = self.medicine(daily((11, 58)))
+        self.medicine_manager.run = fail
+
+        with patch('managers.TimetableManager.log') as log:
+            self.manager.send_queued(self.app, [(Medicine, medicine.id, self.medicine_manager)])
+
+        db.session.expire_all()
+        medicine = db.session.get(Medicine, medicine.id)
+
+        log.assert_called_once()
+        self.assertEqual(ActionRequest.query.count(), 0)
+        self.assertEqual(medicine.next_fire_at, datetime(2026, 10, 19, 8, 58))
+
+    def test_sent_point_is_logged_with_the_send(self):
+        medicine = self.medicine(daily((11, 58)))
+
+        self.manager.send_queued(self.app, [(Medicine, medicine.id, self.medicine_manager)])
+
+        db.session.expire_all()
+        medicine = db.session.get(Medicine, medicine.id)
+
+        # run stamps last_sent with the real clock, so only the request itself is checked here
+        self.assertEqual(ActionRequest.query.filter_by(action='medicine_{}'.format(medicine.id)).count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 git pull
 flask db migrate
 flask db upgrade
+flask rebuild-compliance --if-empty
 sudo pip3 install -r requirements.txt
 sudo cp agents_forms.conf /etc/supervisor/conf.d/
 sudo supervisorctl update
 sudo supervisorctl restart agents-forms
 sudo supervisorctl restart agents-forms-jobs
+sudo supervisorctl restart agents-forms-outbox
 sudo supervisorctl restart agents-forms-celeryd